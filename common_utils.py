@@ -1,72 +1,315 @@
 import re
+import os
+import copy
 import importlib
+import inspect
 import sys
+import numpy as np
 import pandas as pd
 
 
-def read_config_file(filename):
+# Matches uppercase word at start of line
+PARAM_NAME_REGEX = re.compile(r"^[A-Z_]+")
+
+# Matches numbers (with optional decimal points and/or
+# exponent notation) at the end of a line.
+FIXED_VALUE_REGEX = re.compile(r"-?\d+(?:\.\d+)?(?:e[+-]?\d+)?$")
+
+# Matches a word (one or more letters, digits or underscores)
+# enclosed in curly braces.
+FUNCTION_NAME_REGEX = re.compile(r"\{(\w+)\}")
+
+# Matches a comma-separated list of numbers (with optional
+# decimal point and/or exponent notation) enclosed in square
+# brackets.
+FUNCTION_VALUE_REGEX = re.compile(
+    r"\[((?:-?\d*(?:\.\d+)?"
+    + r"(?:e[+-]?\d+)?"
+    + r"|\|[A-Z_]+\|)(?:, ?(?:-?\d*(?:\.\d+)?(?:e[+-]?\d+)?"
+    + r"|\|[A-Z_]+\|))*)\]"
+)
+
+# Matches a reference to another parameter, e.g. |PLUME_HEIGHT|
+PARAM_REF_REGEX = re.compile(r"\|([A-Z_]+)\|")
+
+# Columns of a multiphase parameter file that are not Tephra2 parameters.
+META_COLUMNS = ["REALISATION", "DATE", "PHASE", "PHASE_TYPE"]
+
+# Parsed templates, keyed by (absolute path, modification time).
+_TEMPLATE_CACHE = {}
+
+
+def _parse_config_lines(lines):
     config = {}
-    with open(filename) as f:
-        for line in f:
-            line = line.strip()
-            if not line == "" and not line.startswith("#"):
-                # Matches uppercase word at start of line
-                param_name_regex = r"^[A-Z_]+"
-
-                # Matches numbers (with optional decimal points and/or
-                # exponent notation) at the end of a line.
-                fixed_value_regex = r"-?\d+(?:\.\d+)?(?:e[+-]?\d+)?$"
-
-                # Matches a word (one or more letters, digits or underscores)
-                # enclosed in curly braces.
-                function_name_regex = r"\{(\w+)\}"
-
-                # Matches a comma-separated list of numbers (with optional
-                # decimal point and/or exponent notation) enclosed in square
-                # brackets.
-
-                function_value_regex = (
-                    r"\[((?:-?\d*(?:\.\d+)?"
-                    + r"(?:e[+-]?\d+)?"
-                    + r"|\|[A-Z_]+\|)(?:, ?(?:-?\d*(?:\.\d+)?(?:e[+-]?\d+)?"
-                    + r"|\|[A-Z_]+\|))*)\]"
+    for line in lines:
+        line = line.strip()
+        if not line == "" and not line.startswith("#"):
+            param_name_matches = PARAM_NAME_REGEX.findall(line)
+            fixed_value_matches = FIXED_VALUE_REGEX.findall(line)
+            function_name_matches = FUNCTION_NAME_REGEX.findall(line)
+            function_value_matches = FUNCTION_VALUE_REGEX.findall(line)
+
+            config[param_name_matches[0]] = {}
+
+            if fixed_value_matches:
+                config[param_name_matches[0]]["values"] = [
+                    float(fixed_value_matches[0])
+                ]
+            elif function_name_matches:
+                config[param_name_matches[0]]["sampleFunction"] = (
+                    function_name_matches[0]
                 )
+                config[param_name_matches[0]]["values"] = []
+                for val in function_value_matches[0].split(","):
+                    try:
+                        config[param_name_matches[0]]["values"] += [
+                            float(val.strip())
+                        ]
+                    except ValueError:
+                        config[param_name_matches[0]]["values"] += [val.strip()]
+    return config
 
-                param_name_matches = re.findall(param_name_regex, line)
-                fixed_value_matches = re.findall(fixed_value_regex, line)
-                function_name_matches = re.findall(function_name_regex, line)
-                function_value_matches = re.findall(function_value_regex, line)
 
-                config[param_name_matches[0]] = {}
+class ConfigTemplate:
+    """
+    A parsed Tephra2 configuration template.
+
+    Parsing, dependency extraction and sample function lookup happen once, when the
+    template is built, so the template can be sampled many times by generate_runs.
 
-                if fixed_value_matches:
-                    config[param_name_matches[0]]["values"] = [
-                        float(fixed_value_matches[0])
-                    ]
-                elif function_name_matches:
-                    config[param_name_matches[0]]["sampleFunction"] = (
-                        function_name_matches[0]
+    Attributes
+    ----------
+    params : dict
+        The parsed configuration, in the format returned by read_config_file.
+    dependencies : dict
+        Maps each parameter name to the list of parameter names it references with
+        the |PARAM| syntax. Parameters without references map to an empty list.
+    functions : dict
+        Maps each sampled parameter name to its resolved sample function in
+        custom_functions.
+    vectorised : dict
+        Maps each sampled parameter name to True if its sample function accepts a
+        ``size`` keyword argument.
+    seeded : dict
+        Maps each sampled parameter name to True if its sample function accepts an
+        ``rng`` keyword argument.
+    levels : list of list of str
+        The parameters in topological order of their dependencies. Parameters in a
+        level only reference parameters in earlier levels, so each level can be
+        evaluated in one pass once the previous levels are known.
+
+    Raises
+    ------
+    ValueError
+        If a parameter references an unknown parameter, or if the references form a
+        cycle.
+    """
+
+    def __init__(self, params, filename=None):
+        self.filename = filename
+        self.params = params
+        self.dependencies = {}
+        self.functions = {}
+        self.vectorised = {}
+        self.seeded = {}
+
+        custom_functions = importlib.import_module("custom_functions")
+
+        for param, spec in params.items():
+            self.dependencies[param] = [
+                PARAM_REF_REGEX.match(val).group(1)
+                for val in spec["values"]
+                if isinstance(val, str) and PARAM_REF_REGEX.match(val)
+            ]
+            if "sampleFunction" in spec:
+                fun_name = spec["sampleFunction"]
+                try:
+                    function = getattr(custom_functions, fun_name)
+                except AttributeError:
+                    print(
+                        f'ERROR: Unknown sample function "{fun_name}"'
+                        + f" in config for parameter {param}"
                     )
-                    config[param_name_matches[0]]["values"] = []
-                    for val in function_value_matches[0].split(","):
-                        try:
-                            config[param_name_matches[0]]["values"] += [
-                                float(val.strip())
-                            ]
-                        except ValueError:
-                            config[param_name_matches[0]]["values"] += [val.strip()]
+                    sys.exit(0)
+                self.functions[param] = function
+                self.vectorised[param] = _accepts_keyword(function, "size")
+                self.seeded[param] = _accepts_keyword(function, "rng")
 
-    return config
+        self.levels = dependency_levels(self.dependencies)
+
+    def keys(self):
+        return self.params.keys()
+
+    def __len__(self):
+        return len(self.params)
+
+
+def dependency_levels(dependencies):
+    """
+    Orders parameters into levels of a dependency graph (Kahn's algorithm).
+
+    Parameters
+    ----------
+    dependencies : dict
+        Maps each parameter name to the list of parameter names it depends on.
+
+    Returns
+    -------
+    list of list of str
+        The parameters grouped by level. Level 0 holds the parameters without
+        dependencies, and every parameter in level n depends only on parameters in
+        levels 0 to n - 1. Parameters keep their original order within a level.
+
+    Raises
+    ------
+    ValueError
+        If a parameter depends on an unknown parameter, or if the dependencies form
+        a cycle.
+    """
+    for param, deps in dependencies.items():
+        unknown = [dep for dep in deps if dep not in dependencies]
+        if unknown:
+            raise ValueError(
+                f"Parameter {param} references unknown parameter(s): "
+                + ", ".join(unknown)
+            )
+
+    remaining = {param: set(deps) for param, deps in dependencies.items()}
+    levels = []
+    while remaining:
+        level = [param for param, deps in remaining.items() if not deps]
+        if not level:
+            raise ValueError(
+                "Cyclic parameter references between: " + ", ".join(remaining)
+            )
+        for param in level:
+            del remaining[param]
+        for deps in remaining.values():
+            deps.difference_update(level)
+        levels += [level]
+    return levels
+
+
+def load_config_template(filename):
+    """
+    Returns the parsed ConfigTemplate for a config file.
+
+    Templates are memoized by absolute path and modification time, so a file is only
+    parsed again after it has changed on disk.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the configuration file.
+
+    Returns
+    -------
+    ConfigTemplate
+        The parsed template.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the configuration file does not exist.
+    """
+    key = (os.path.abspath(filename), os.path.getmtime(filename))
+    if key not in _TEMPLATE_CACHE:
+        with open(filename) as f:
+            params = _parse_config_lines(f)
+        _TEMPLATE_CACHE[key] = ConfigTemplate(params, filename=filename)
+    return _TEMPLATE_CACHE[key]
+
+
+def read_config_file(filename):
+    return copy.deepcopy(load_config_template(filename).params)
 
 
-def generate_runs(config_dict, runs=1):
+def _accepts_keyword(function, name):
+    """Return True if ``function`` accepts a keyword argument called ``name``."""
+    try:
+        return name in inspect.signature(function).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def make_rng(seed=None):
+    """
+    Returns a numpy.random.Generator for the given seed.
+
+    Parameters
+    ----------
+    seed : None, int, numpy.random.SeedSequence or numpy.random.Generator
+        Seed of the generator. None seeds it from fresh OS entropy, and a Generator
+        is returned unchanged.
+
+    Returns
+    -------
+    numpy.random.Generator
+        The random number generator.
+    """
+    return np.random.default_rng(seed)
+
+
+def spawn_seeds(seed, n):
+    """
+    Spawns ``n`` independent child seed sequences from a seed.
+
+    Child streams do not overlap, and only depend on ``seed`` and their position, so
+    work split across processes stays both reproducible and uncorrelated.
+
+    Parameters
+    ----------
+    seed : None, int or numpy.random.SeedSequence
+        The parent seed. None uses fresh OS entropy.
+    n : int
+        The number of child seed sequences.
+
+    Returns
+    -------
+    list of numpy.random.SeedSequence
+        The child seed sequences.
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return seed.spawn(n)
+
+
+def _sample(function, args, runs, vectorised, rng=None, seeded=False):
+    """
+    Draws ``runs`` values from a sample function.
+
+    Vectorised functions (those accepting a ``size`` keyword) are called once with
+    ``size=runs`` and may be given array arguments. Any other function is called
+    once per run, with the i-th element of each array argument. Functions accepting
+    an ``rng`` keyword draw from ``rng``.
+    """
+    kwargs = {"rng": rng} if seeded else {}
+    if vectorised:
+        values = np.asarray(function(*args, size=runs, **kwargs), dtype=float)
+        return np.broadcast_to(values, (runs,)).copy()
+
+    columns = [np.broadcast_to(arg, (runs,)) for arg in args]
+    return np.array(
+        [function(*row_args, **kwargs) for row_args in zip(*columns)], dtype=float
+    ).reshape(runs)
+
+
+def generate_runs(config_dict, runs=1, rng=None):
     """
     Generates run parameters using custom functions based on the given configuration
     dictionary.
 
+    Sample functions that accept a ``size`` keyword are called once per parameter
+    and return all ``runs`` values as a NumPy array. Dependent parameters, such as
+    ``{mastin_mass} [|PLUME_HEIGHT|]``, are evaluated column-wise on the arrays of
+    the parameters they reference, in the topological order given by
+    ConfigTemplate.levels, so chains of references (A -> B -> C) are supported in
+    any order in the file. Functions without a ``size`` keyword are called once per
+    run instead.
+
     Parameters
     ----------
-    config_dict : dict
+    config_dict : dict or ConfigTemplate
         A dictionary containing the configuration details for the run parameters. Each
         key in the dictionary represents a parameter name, and its value is a dictionary
         containing the following keys:
@@ -74,8 +317,13 @@ def generate_runs(config_dict, runs=1):
         'sampleFunction' - (optional) the name of the custom function to be used for
                            sampling values for the parameter.
                            If not specified, the 'values' key will be used as is.
+        A ConfigTemplate from load_config_template can be passed instead, which
+        avoids resolving the sample functions again on every call.
     runs : int, optional
         The number of runs to be generated for each parameter. Defaults to 1.
+    rng : numpy.random.Generator, optional
+        Random number generator passed to sample functions that accept an ``rng``
+        keyword. Defaults to a fresh unseeded generator.
 
     Returns
     -------
@@ -88,56 +336,142 @@ def generate_runs(config_dict, runs=1):
     ------
     ImportError
         If an unknown sample function is specified in the configuration for a parameter.
+    ValueError
+        If the |PARAM| references in the configuration are unknown or cyclic.
 
     """
-    custom_functions = importlib.import_module("custom_functions")
+    rng = make_rng(rng)
+    if isinstance(config_dict, ConfigTemplate):
+        template = config_dict
+    else:
+        template = ConfigTemplate(config_dict)
+    params = template.params
 
-    run_params = []
+    run_params = {}
 
-    for param in config_dict:
-        if "sampleFunction" in config_dict[param].keys():
-            fun_name = config_dict[param]["sampleFunction"]
-            try:
-                function = getattr(custom_functions, fun_name)
-                values = []
-                for i in range(runs):
-                    all_floats = all(
-                        isinstance(item, float) for item in config_dict[param]["values"]
-                    )
-                    if all_floats:
-                        values += [function(*config_dict[param]["values"])]
-                    else:
-                        values += [config_dict[param]["values"]]
-            except ImportError:
-                print(
-                    f'ERROR: Unknown sample function "{fun_name}"'
-                    + f" in config for parameter {param}"
+    # Evaluate the dependency graph level by level, so every |PARAM| reference
+    # points to a column that has already been generated.
+    for level in template.levels:
+        for param in level:
+            if param in template.functions:
+                args = [
+                    run_params[PARAM_REF_REGEX.match(val).group(1)]
+                    if isinstance(val, str)
+                    else val
+                    for val in params[param]["values"]
+                ]
+                run_params[param] = _sample(
+                    template.functions[param],
+                    args,
+                    runs,
+                    template.vectorised[param],
+                    rng,
+                    template.seeded[param],
+                )
+            else:
+                run_params[param] = np.repeat(
+                    np.asarray(params[param]["values"], dtype=float), runs
                 )
-                sys.exit(0)
-            run_params += [values]
-        else:
-            run_params += [config_dict[param]["values"] * (runs)]
-    run_df = pd.DataFrame(run_params, index=config_dict.keys()).T
-
-    for param in run_df.columns:
-        if not all(isinstance(item, float) for item in run_df[param].values):
-            func_vals = []
-            for val in run_df[param].values[0]:
-                if isinstance(val, float):
-                    func_vals += [[val] * len(run_df)]
-                else:
-                    pattern = r"\|([A-Z_]+)\|"
-                    dep_param = re.match(pattern, val).group(1)
-                    gen_params = run_df[dep_param].to_list()
-                    func_vals += [gen_params]
-            gen_values = []
-            for splat_params in zip(*func_vals):
-                fun_name = config_dict[param]["sampleFunction"]
-                if fun_name in globals():
-                    gen_values += [globals()[fun_name](*splat_params)]
-                else:
-                    function = getattr(custom_functions, fun_name)
-                    gen_values += [function(*splat_params)]
-            run_df[param] = gen_values
+
+    run_df = pd.DataFrame(run_params, columns=list(params.keys()))
 
     return run_df
+
+
+class PhaseTimeline:
+    """
+    Start and end dates of every phase in a multiphase configuration.
+
+    The dates are computed once, with cumulative sums over the phase durations and
+    quiescences, and can be saved next to the generated parameter file so that the
+    runner and reporting tools read the same timeline as the generator.
+
+    Attributes
+    ----------
+    df : pandas.DataFrame
+        One row per phase, indexed by phase number, with the columns "Phase Type",
+        "Phase Duration", "Following Quiescence", "Phase Start" and "Phase End".
+    """
+
+    columns = [
+        "Phase Type",
+        "Phase Duration",
+        "Following Quiescence",
+        "Phase Start",
+        "Phase End",
+    ]
+
+    def __init__(self, df):
+        self.df = df
+
+    @classmethod
+    def from_config(cls, config, start_date):
+        """
+        Computes the timeline of a multiphase configuration.
+
+        Parameters
+        ----------
+        config : pandas.DataFrame
+            The multiphase configuration, as read by read_multiphase_config.
+        start_date : str or datetime.datetime
+            The date at which phase 0 begins.
+
+        Returns
+        -------
+        PhaseTimeline
+            The timeline of the configuration.
+        """
+        start = pd.Timestamp(start_date)
+        durations = pd.to_timedelta(config["Phase Duration"].astype(float), unit="D")
+        # The Following Quiescence of the last phase is "END", so it is left out.
+        quiescence = np.zeros(len(config))
+        quiescence[:-1] = config["Following Quiescence"].iloc[:-1].astype(int)
+        quiescence = pd.to_timedelta(quiescence, unit="D")
+
+        # Each phase starts after all preceding phases and quiescences.
+        offsets = (durations + quiescence).cumsum() - durations - quiescence
+
+        df = pd.DataFrame(
+            {
+                "Phase Type": config["Phase Type"].to_numpy(),
+                "Phase Duration": config["Phase Duration"].to_numpy(),
+                "Following Quiescence": config["Following Quiescence"].to_numpy(),
+                "Phase Start": (start + offsets).to_numpy(),
+                "Phase End": (start + offsets + durations).to_numpy(),
+            },
+            index=pd.Index(config.index, name="PHASE"),
+        )
+        return cls(df)
+
+    @classmethod
+    def from_csv(cls, filename):
+        """Reads a timeline written by PhaseTimeline.to_csv."""
+        df = pd.read_csv(
+            filename, index_col="PHASE", parse_dates=["Phase Start", "Phase End"]
+        )
+        return cls(df)
+
+    def to_csv(self, filename):
+        self.df.to_csv(filename)
+
+    @property
+    def start(self):
+        return self.df["Phase Start"].iloc[0]
+
+    @property
+    def end(self):
+        return self.df["Phase End"].iloc[-1]
+
+    def phase_start(self, phase):
+        return self.df.loc[phase, "Phase Start"]
+
+    def phase_end(self, phase):
+        return self.df.loc[phase, "Phase End"]
+
+    def __len__(self):
+        return len(self.df)
+
+
+def timeline_filename(parameter_file):
+    """Returns the path of the timeline saved next to a multiphase parameter file."""
+    return f"{os.path.splitext(parameter_file)[0]}_timeline.csv"
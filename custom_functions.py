@@ -1,41 +1,56 @@
 import numpy as np
-import random
 from scipy.stats import lognorm, fisk, norm
 
-
-def unif(a, b):
-    uni = random.uniform(a, b)
+# Sample functions take an optional ``size`` keyword. When ``size`` is None a
+# single value is returned, otherwise a NumPy array of ``size`` values is
+# returned. Arguments may also be arrays of length ``size`` when a parameter
+# depends on another parameter, e.g. {mastin_mass} [|PLUME_HEIGHT|].
+# Functions without a ``size`` keyword are still supported by
+# common_utils.generate_runs, but are called once per run.
+#
+# Random sample functions also take an optional ``rng`` keyword, which is the
+# numpy.random.Generator to draw from. When it is None, a fresh unseeded
+# generator is used.
+
+
+def unif(a, b, size=None, rng=None):
+    rng = np.random.default_rng(rng)
+    uni = rng.uniform(a, b, size=size)
     return uni
 
 
-def log_unif(a, b):
-    uni = np.exp(random.uniform(np.log(a), np.log(b)))
+def log_unif(a, b, size=None, rng=None):
+    rng = np.random.default_rng(rng)
+    uni = np.exp(rng.uniform(np.log(a), np.log(b), size=size))
     return uni
 
 
-def trunc_lognorm(mean, std, max_val):
+def trunc_lognorm(mean, std, max_val, size=None, rng=None):
+    rng = np.random.default_rng(rng)
     mu = np.log(mean ** 2 / np.sqrt(std ** 2 + mean ** 2))
     sigma = np.sqrt(np.log(std ** 2 / mean ** 2 + 1))
-    sample = lognorm.rvs(s=sigma, scale=np.exp(mu), loc=0, size=1)
-    if sample > max_val:
-        return max_val
-    else:
-        return sample
+    sample = lognorm.rvs(
+        s=sigma, scale=np.exp(mu), loc=0, size=size, random_state=rng
+    )
+    return np.minimum(sample, max_val)
 
 
-def gamma_col(shape, scale):
-    return 1000*np.random.gamma(shape, scale)
+def gamma_col(shape, scale, size=None, rng=None):
+    rng = np.random.default_rng(rng)
+    return 1000*rng.gamma(shape, scale, size=size)
 
 
 def mastin_mass(
-    H,
+    H, size=None
 ):
     # Calculate the volume from Mastin et al. (2009)
     # This is volume in km^3, so I assume it takes in the
     # column height in km.
     # This value is the dense rock equivalent (DRE), which
     # is the volume of the magma before it gets fizzy and hard.
-    V = 10**((H/1000 - 25.9) / 6.64)
+    # H can be a scalar or an array of column heights, so size
+    # is only accepted to mark this function as vectorised.
+    V = 10**((np.asarray(H)/1000 - 25.9) / 6.64)
 
     # Density of DRE magma with no voids or bubbles
     magma_density = 2500
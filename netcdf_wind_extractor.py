@@ -4,12 +4,181 @@ import pandas as pd
 import numpy as np
 import datetime as dt
 from typing import List, Union
-from functools import reduce
+from functools import reduce, lru_cache
+import hashlib
+import json
+import logging
 import os
 
 
+# Resolution of a WindCube that holds the time steps of the file as they are.
+NATIVE = "nearest"
+
+
+def bin_width(freq):
+    """
+    Returns the width in nanoseconds of the time bins of a pandas frequency string.
+
+    Bins are read and cached day by day, so they must split a day evenly, e.g. "D",
+    "6h" or "30min". Wider bins would cross the blocks of days that read_ncdf_cube
+    reads at once, and give duplicate bins.
+
+    Raises
+    ------
+    ValueError
+        If the bins do not split a day evenly.
+    """
+    if not freq[0].isdigit():
+        freq = f"1{freq}"
+    width = pd.Timedelta(freq).value
+    day = pd.Timedelta("1D").value
+    if width <= 0 or width > day or day % width:
+        raise ValueError(
+            f"Wind resolution {freq} must split a day evenly, e.g. D, 6h or h."
+        )
+    return width
+
+
+def floor_times(times, freq):
+    """
+    Rounds datetime64 timestamps down to the start of their time bin.
+
+    Parameters
+    ----------
+    times : numpy.ndarray
+        datetime64 timestamps.
+    freq : str
+        Width of the time bins as a pandas frequency string, e.g. "D", "6h" or
+        "h". Bins are aligned to the unix epoch, so daily bins start at midnight.
+        See bin_width.
+
+    Returns
+    -------
+    numpy.ndarray
+        The datetime64[ns] label of the bin of each timestamp.
+    """
+    width = bin_width(freq)
+    ns = np.asarray(times, dtype="datetime64[ns]").astype(np.int64)
+    return (ns - ns % width).astype("datetime64[ns]")
+
+
+class WindCube:
+    """
+    Time-aggregated wind components held as a dense array.
+
+    Attributes
+    ----------
+    times : numpy.ndarray
+        Sorted datetime64[ns] labels of the time bins (midnight for daily means).
+    components : numpy.ndarray
+        Values of the wind component coordinate (1 for U, 2 for V).
+    levels : numpy.ndarray
+        Values of the level coordinate.
+    data : numpy.ndarray
+        Wind speed components, with shape (time, component, level).
+    freq : str
+        Width of the time bins as a pandas frequency string (e.g. "D" or "h"), or
+        NATIVE if the cube holds the time steps of the file without aggregation.
+    """
+
+    def __init__(self, times, components, levels, data, freq="D"):
+        self.times = times
+        self.components = components
+        self.levels = levels
+        self.data = data
+        self.freq = freq
+
+    def time_index(self, times):
+        """
+        Returns the positions of the given timestamps along the time axis.
+
+        Each timestamp is matched to the time bin it falls in or, for a NATIVE
+        cube, to the nearest time step in the file.
+
+        Raises
+        ------
+        KeyError
+            If a timestamp falls in a bin without wind data or, for a NATIVE cube,
+            is more than one time step away from the nearest time step.
+        """
+        times = np.asarray(times, dtype="datetime64[ns]")
+        if self.freq == NATIVE:
+            right = np.clip(np.searchsorted(self.times, times), 0, len(self.times) - 1)
+            left = np.maximum(right - 1, 0)
+            closer_left = np.abs(times - self.times[left]) <= np.abs(
+                self.times[right] - times
+            )
+            idx = np.where(closer_left, left, right)
+            # Typical spacing of the time steps, zero for a single time step
+            step = np.median(np.diff(self.times)) if len(self.times) > 1 else 0
+            missing = np.abs(times - self.times[idx]) > step
+            if np.any(missing):
+                raise KeyError(
+                    f"No wind data within a time step of {times[missing][0]}"
+                )
+            return idx
+
+        times = floor_times(times, self.freq)
+        idx = np.searchsorted(self.times, times)
+        idx = np.minimum(idx, len(self.times) - 1)
+        missing = self.times[idx] != times
+        if np.any(missing):
+            raise KeyError(f"No wind data for {times[missing][0]}")
+        return idx
+
+    def component_index(self, component):
+        return int(np.flatnonzero(self.components == component)[0])
+
+    def to_dataframe(self):
+        """
+        Returns the cube as a pandas DataFrame with a (Time, wind direction)
+        MultiIndex and one column per level.
+        """
+        index = pd.MultiIndex.from_product(
+            [pd.DatetimeIndex(self.times), self.components],
+            names=["Time", "wind direction"],
+        )
+        return pd.DataFrame(
+            self.data.reshape(-1, len(self.levels)),
+            index=index,
+            columns=pd.Index(self.levels, name="level"),
+        )
+
+    @classmethod
+    def from_dataframe(cls, df, freq="D"):
+        """
+        Builds a cube from a DataFrame laid out like the one of to_dataframe, or
+        returned by read_ncdf.
+        """
+        df = df.sort_index()
+        times = df.index.get_level_values(0).unique()
+        components = df.index.get_level_values(1).unique()
+        data = df.reindex(pd.MultiIndex.from_product([times, components]))
+        return cls(
+            times.values.astype("datetime64[ns]"),
+            np.asarray(components, dtype=int),
+            df.columns.values,
+            data.to_numpy(dtype=np.float64).reshape(
+                len(times), len(components), -1
+            ),
+            freq,
+        )
+
+
+# Version of the on-disk cache layout. Bump it when the layout or the
+# aggregation changes, so stale caches are not read back.
+CACHE_VERSION = 2
+
+
 class NetCDFWindExtractor:
-    def __init__(self, netcdf_file_path):
+    def __init__(
+        self,
+        netcdf_file_path,
+        cache_dir=None,
+        time_window=None,
+        heights_file="heights.csv",
+        resolution="D",
+    ):
         """
         Initialize the NetCDFWindExtractor instance.
 
@@ -17,20 +186,80 @@ class NetCDFWindExtractor:
         -----------
         netcdf_file_path : str
             The path to the NetCDF file containing wind data.
+        cache_dir : str, optional
+            Directory for the preprocessed wind cache. If given, the aggregated
+            wind data is memory-mapped from the cache when the NetCDF file has
+            been processed before, and written to the cache otherwise.
+        time_window : tuple, optional
+            (start, end) dates, inclusive, of the wind data to load. Only this part
+            of the file is read, which bounds memory use for long files. Defaults
+            to the whole file.
+        heights_file : str, optional
+            File with the height of each level, one per line. Defaults to
+            "heights.csv" in the current working directory.
+        resolution : str, optional
+            Default time resolution of the extracted wind: a pandas frequency
+            string such as "D" (daily means), "6h" or "h", or "nearest" for the
+            time step of the file closest to each event. Defaults to "D".
         """
         self.netcdf_file_path = netcdf_file_path
-        self.df = read_ncdf(netcdf_file_path)
+        self.cache_dir = cache_dir
+        self.time_window = time_window
+        self.heights_file = heights_file
+        self.resolution = resolution
+        self._cubes = {}
+        self.cube = self.cube_at(resolution)
+        self._df = None
+
+    def cube_at(self, resolution):
+        """
+        Returns the WindCube aggregated to the given time resolution.
+
+        Each resolution is only aggregated once per extractor (and once per
+        cache directory), so serving several resolutions costs one aggregation
+        each, not one per extraction.
+        """
+        if resolution not in self._cubes:
+            if NATIVE in self._cubes and resolution != NATIVE:
+                # Aggregating the time steps already in memory beats re-reading.
+                native = self._cubes[NATIVE]
+                times, data = aggregate_time(native.times, native.data, resolution)
+                cube = WindCube(
+                    times, native.components, native.levels, data, resolution
+                )
+            elif self.cache_dir is None:
+                cube = read_ncdf_cube(
+                    self.netcdf_file_path, self.time_window, freq=resolution
+                )
+            else:
+                cube = read_cached_ncdf(
+                    self.netcdf_file_path,
+                    self.cache_dir,
+                    self.time_window,
+                    resolution,
+                )
+            self._cubes[resolution] = cube
+        return self._cubes[resolution]
+
+    @property
+    def df(self):
+        """The wind data as a pandas DataFrame, built on first access."""
+        if self._df is None:
+            self._df = self.cube.to_dataframe()
+        return self._df
 
     def _read_ncdf(self):
         """
-        Read the NetCDF file containing wind data into a pandas dataframe.
+        Read the wind data in the time window of the NetCDF file into a WindCube.
 
         Returns:
         --------
-        pandas.DataFrame
-            The wind data as a pandas dataframe.
+        WindCube
+            The mean wind data at the resolution of the extractor.
         """
-        return read_ncdf(self.netcdf_file_path)
+        return read_ncdf_cube(
+            self.netcdf_file_path, self.time_window, freq=self.resolution
+        )
 
     def extract_tephra2_wind(self, dates):
         """
@@ -52,42 +281,327 @@ class NetCDFWindExtractor:
             A list of pandas DataFrames containing the wind data for each date in
             dates.
         """
-        winds = extract_tephra2_wind_data(self.df, dates)
+        winds = extract_tephra2_wind_data(self.cube, dates, self.heights_file)
         return winds
 
+    def extract_tephra2_wind_array(self, dates, resolution=None):
+        """
+        Extracts the Tephra2 wind profiles for many dates as one array.
+
+        Parameters:
+        ----------
+        dates : str or list of str or list of datetime.date or numpy.ndarray
+            The dates, in any format accepted by parse_date_arg, or an array of
+            datetime64 event timestamps.
+        resolution : str, optional
+            Time resolution of the wind, see NetCDFWindExtractor. Defaults to the
+            resolution of the extractor.
+
+        Returns:
+        -------
+        numpy.ndarray
+            Array of shape (n_dates, n_levels, 3) holding the height, speed and
+            angle of every level on every date.
+        """
+        cube = self.cube_at(resolution or self.resolution)
+        return extract_tephra2_wind_array(cube, dates, self.heights_file)
 
-def read_ncdf(ncdf_file):
+
+def _wind_dims(speed):
+    """
+    Identifies the (time, level, component) dimensions of the speed variable.
+
+    The time dimension is the one with a datetime or timedelta coordinate, and the
+    component dimension is the remaining one of length 2 (U and V).
+    """
+    dims = list(speed.dims)
+    time_dim = next(
+        (d for d in dims if d in speed.coords and speed[d].dtype.kind in "mM"),
+        dims[0],
+    )
+    others = [d for d in dims if d != time_dim]
+    component_dim = next(
+        (d for d in reversed(others) if speed.sizes[d] == 2), others[-1]
+    )
+    level_dim = next(d for d in others if d != component_dim)
+    return time_dim, level_dim, component_dim
+
+
+def _to_datetime64(times):
+    # Time is stored as an offset from the unix epoch in some files.
+    if times.dtype.kind == "m":
+        times = np.datetime64("1970-01-01", "ns") + times.astype("timedelta64[ns]")
+    return times.astype("datetime64[ns]")
+
+
+def aggregate_time(times, data, freq="D"):
+    """
+    Averages data into time bins along the first axis.
+
+    NaN values are ignored, and bins without any data are left out.
+
+    Parameters
+    ----------
+    times : numpy.ndarray
+        datetime64 timestamps of the first axis of data.
+    data : numpy.ndarray
+        The data to aggregate.
+    freq : str
+        Width of the bins as a pandas frequency string, e.g. "D" for daily means,
+        or NATIVE to keep every time step.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        The sorted bin labels, and the mean of the data in each bin.
+    """
+    order = np.argsort(times, kind="stable")
+    data = data[order]
+    if freq == NATIVE:
+        return np.asarray(times[order], dtype="datetime64[ns]"), data
+    bins = floor_times(times[order], freq)
+
+    labels, starts = np.unique(bins, return_index=True)
+    valid = ~np.isnan(data)
+    sums = np.add.reduceat(np.where(valid, data, 0), starts, axis=0)
+    counts = np.add.reduceat(valid, starts, axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+    return labels, means
+
+
+def _day_window(time_window):
+    """Converts a (start, end) pair of dates into inclusive datetime64 day bounds."""
+    start, end = time_window
+    return (
+        np.datetime64(pd.Timestamp(start).date(), "D"),
+        np.datetime64(pd.Timestamp(end).date(), "D"),
+    )
+
+
+def read_ncdf(ncdf_file, time_window=None, block_days=31, freq="D"):
     """
     Read wind data from a NetCDF file and return it as a pandas dataframe.
 
+    The parameters are those of read_ncdf_cube, which this wraps.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        The mean wind data, with a (Time, wind direction) MultiIndex and one
+        column per level, see WindCube.to_dataframe.
+    """
+    return read_ncdf_cube(ncdf_file, time_window, block_days, freq).to_dataframe()
+
+
+def read_ncdf_cube(ncdf_file, time_window=None, block_days=31, freq="D"):
+    """
+    Read wind data from a NetCDF file and return it as a WindCube of time means.
+
+    The dataset is opened lazily and only the time steps inside time_window are
+    read, block_days days at a time. Each block is averaged per time bin before
+    the next one is read, so memory use is bounded by the block size and not by
+    the size of the file.
+
     Parameters:
     -----------
     ncdf_file : str
         The path to the NetCDF file containing wind data.
+    time_window : tuple, optional
+        (start, end) dates, inclusive, of the wind data to read. Defaults to the
+        whole file.
+    block_days : int, optional
+        Number of days read from the file at once. Defaults to 31.
+    freq : str, optional
+        Width of the time bins as a pandas frequency string, e.g. "D" for daily
+        means or "h" for hourly means, or "nearest" to keep the time steps of the
+        file. Bins must split a day evenly, see bin_width. Defaults to "D".
 
     Returns:
     --------
-    pandas.DataFrame
-        The wind data as a pandas dataframe.
+    WindCube
+        The mean wind data, with shape (time bin, component, level).
     """
-    ds = xr.open_dataset(ncdf_file)
-    df = ds.to_dataframe()
+    if freq != NATIVE:
+        bin_width(freq)
+    with xr.open_dataset(ncdf_file) as ds:
+        speed = ds["speed"]
+        time_dim, level_dim, component_dim = _wind_dims(speed)
+        speed = speed.transpose(time_dim, component_dim, level_dim)
+
+        # Only the coordinates are read here, the data stays on disk.
+        times = _to_datetime64(speed[time_dim].values)
+        components = speed[component_dim].values.astype(int)
+        levels = speed[level_dim].values
+
+        days = times.astype("datetime64[D]")
+        if time_window is None:
+            idx = np.arange(len(times))
+        else:
+            start, end = _day_window(time_window)
+            idx = np.flatnonzero((days >= start) & (days <= end))
+        idx = idx[np.argsort(times[idx], kind="stable")]
+
+        # Split the window into blocks of whole days.
+        _, day_starts = np.unique(days[idx], return_index=True)
+        block_starts = np.append(day_starts[::block_days], len(idx))
+
+        labels = []
+        means = []
+        for first, last in zip(block_starts[:-1], block_starts[1:]):
+            block_idx = idx[first:last]
+            if np.all(np.diff(block_idx) == 1):
+                # Contiguous reads are much faster than fancy indexing.
+                block_idx = slice(block_idx[0], block_idx[-1] + 1)
+            data = speed.isel({time_dim: block_idx}).values.astype(np.float64)
+            block_labels, block_means = aggregate_time(
+                times[idx[first:last]], data, freq
+            )
+            labels += [block_labels]
+            means += [block_means]
+
+    if not labels:
+        raise ValueError(f"No wind data in {ncdf_file} for {time_window}")
+
+    return WindCube(
+        np.concatenate(labels), components, levels, np.concatenate(means), freq
+    )
 
-    df = df["speed"].unstack(level=1)
 
-    # Parsing multiindex values to be dates and ints respectively
-    new_tuples = df.index.map(
-        lambda x: (
-            pd.to_datetime(x[0].total_seconds(), unit="s", origin="unix"),
-            int(x[1]),
-        )
+def file_hash(filename, chunk_size=2**20):
+    """Returns the SHA-256 hex digest of a file's contents."""
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _cached_file_hash(filename, size, mtime_ns, cache_dir):
+    sidecar = None
+    if cache_dir is not None:
+        name = hashlib.sha256(filename.encode()).hexdigest()
+        sidecar = os.path.join(cache_dir, "hashes", f"{name}.json")
+        try:
+            with open(sidecar) as f:
+                record = json.load(f)
+            if (record["size"], record["mtime_ns"]) == (size, mtime_ns):
+                return record["sha256"]
+        except (OSError, ValueError, KeyError):
+            pass
+    digest = file_hash(filename)
+    if sidecar is not None:
+        os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+        tmp_path = f"{sidecar}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "path": filename,
+                    "size": size,
+                    "mtime_ns": mtime_ns,
+                    "sha256": digest,
+                },
+                f,
+            )
+        os.replace(tmp_path, sidecar)
+    return digest
+
+
+def cached_file_hash(filename, cache_dir=None):
+    """
+    Returns the file_hash of a file, hashing each version of the file only once.
+
+    A file is taken to be unchanged while its size and modification time are. The
+    hash is kept for the rest of the process and, if ``cache_dir`` is given, in a
+    sidecar file under ``cache_dir/hashes``, so that a large NetCDF file is not
+    read in full at every start.
+    """
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    return _cached_file_hash(filename, stat.st_size, stat.st_mtime_ns, cache_dir)
+
+
+def cache_key(ncdf_file, freq="D", time_window=None, cache_dir=None):
+    """
+    Returns the cache key of a NetCDF file aggregated to the given time bins.
+
+    The key is derived from the file contents and the aggregation settings, so a
+    changed file or different settings never reuse a stale cache entry. The
+    contents are hashed with cached_file_hash, whose sidecar is kept in
+    ``cache_dir`` if given.
+    """
+    window = "all" if time_window is None else ":".join(
+        str(d) for d in _day_window(time_window)
     )
-    df.index = pd.MultiIndex.from_tuples(new_tuples, names=["Time", "wind direction"])
+    settings = f"v{CACHE_VERSION}:speed:{freq}:{window}"
+    source = cached_file_hash(ncdf_file, cache_dir)
+    digest = hashlib.sha256(f"{source}:{settings}".encode())
+    return digest.hexdigest()
 
-    # Aggregate to daily level (stacking and unstacking because multiindex)
-    df = df.unstack(level=1).resample("D").mean().stack(level=1)
 
-    return df
+def save_cube(cube, cache_path):
+    """
+    Saves a WindCube as .npy files in the directory cache_path.
+
+    The files are written to a temporary directory first and moved into place, so
+    an interrupted write never leaves a partial cache entry behind.
+    """
+    tmp_path = f"{cache_path}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    for name in ["times", "components", "levels", "data"]:
+        np.save(os.path.join(tmp_path, f"{name}.npy"), getattr(cube, name))
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # Another process wrote the same entry first.
+        for name in os.listdir(tmp_path):
+            os.remove(os.path.join(tmp_path, name))
+        os.rmdir(tmp_path)
+
+
+def load_cube(cache_path, freq="D"):
+    """Memory-maps a WindCube saved by save_cube."""
+    arrays = {
+        name: np.load(os.path.join(cache_path, f"{name}.npy"), mmap_mode="r")
+        for name in ["times", "components", "levels", "data"]
+    }
+    return WindCube(freq=freq, **arrays)
+
+
+def read_cached_ncdf(ncdf_file, cache_dir, time_window=None, freq="D"):
+    """
+    Returns the WindCube of a NetCDF file, using an on-disk cache.
+
+    Parameters:
+    -----------
+    ncdf_file : str
+        The path to the NetCDF file containing wind data.
+    cache_dir : str
+        The cache directory. Entries are keyed by cache_key.
+    time_window : tuple, optional
+        (start, end) dates, inclusive, of the wind data to read. Defaults to the
+        whole file.
+    freq : str, optional
+        Time resolution of the cube, see read_ncdf_cube. Each resolution is cached
+        separately. Defaults to "D".
+
+    Returns:
+    --------
+    WindCube
+        The mean wind data. Arrays are memory-mapped from the cache.
+    """
+    key = cache_key(ncdf_file, freq, time_window, cache_dir)
+    cache_path = os.path.join(cache_dir, key)
+    if os.path.isdir(cache_path):
+        logging.debug(f"Loading wind data from cache {cache_path}")
+        return load_cube(cache_path, freq)
+
+    logging.debug(f"Wind cache miss, writing {cache_path}")
+    cube = read_ncdf_cube(ncdf_file, time_window, freq=freq)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_cube(cube, cache_path)
+    return load_cube(cache_path, freq)
 
 
 def get_wind_speed_and_angle(u, v):
@@ -117,17 +631,100 @@ def get_wind_speed_and_angle(u, v):
     return speed, angle
 
 
+@lru_cache(maxsize=None)
+def _load_heights(heights_file, mtime):
+    heights = np.loadtxt(heights_file, delimiter=",", ndmin=1)
+    heights.setflags(write=False)
+    return heights
+
+
+def load_heights(heights_file="heights.csv"):
+    """
+    Returns the height of each wind level, read from a file with one per line.
+
+    The file is only read again when its modification time changes.
+    """
+    heights_file = os.path.abspath(heights_file)
+    return _load_heights(heights_file, os.path.getmtime(heights_file))
+
+
+def extract_tephra2_wind_array(
+    cube: WindCube,
+    dates: Union[str, List[Union[str, dt.date]]],
+    heights_file: str = "heights.csv",
+) -> np.ndarray:
+    """
+    Extracts the Tephra2 wind profiles for many dates as one array.
+
+    Speed and angle are computed for all dates and levels in a single vectorised
+    call.
+
+    Parameters:
+    ----------
+    cube : WindCube
+        The wind data, as returned by read_ncdf_cube.
+    dates : str or list of str or list of datetime.date or numpy.ndarray
+        The dates, in any format accepted by parse_date_arg, or an array of
+        datetime64 event timestamps. Each is matched to a time step of the cube
+        with WindCube.time_index.
+    heights_file : str, optional
+        File with the height of each level, one per line.
+
+    Returns:
+    -------
+    numpy.ndarray
+        Array of shape (n_dates, n_levels, 3) holding the height, speed and angle
+        of every level on every date.
+    """
+    if isinstance(dates, np.ndarray) and dates.dtype.kind == "M":
+        times = dates
+    else:
+        times = np.array(parse_date_arg(dates), dtype="datetime64[D]")
+    time_idx = cube.time_index(times)
+
+    # Hacking actual heights in here because I don't know how to get them from the
+    # netcdf. I work with what I get.
+    heights = load_heights(heights_file)
+
+    # Select wind data for the given dates and wind directions.
+    wind_u = cube.data[time_idx, cube.component_index(1)]
+    wind_v = cube.data[time_idx, cube.component_index(2)]
+
+    winds = np.empty(wind_u.shape + (3,))
+    winds[:, :, 0] = heights
+    # Compute wind speed and angle from the wind components.
+    winds[:, :, 1], winds[:, :, 2] = get_wind_speed_and_angle(wind_u, wind_v)
+    return winds
+
+
+def wind_frame(profile: np.ndarray) -> pd.DataFrame:
+    """
+    Returns a DataFrame view of one (n_levels, 3) wind profile, indexed by level.
+
+    The DataFrame shares memory with the profile array.
+    """
+    return pd.DataFrame(
+        profile,
+        columns=["Height", "Speed", "Angle"],
+        index=range(1, len(profile) + 1),
+        copy=False,
+    )
+
+
 def extract_tephra2_wind_data(
-    ncdf_df: pd.DataFrame, dates: Union[str, List[Union[str, dt.date]]]
+    ncdf_df: Union[pd.DataFrame, WindCube],
+    dates: Union[str, List[Union[str, dt.date]]],
+    heights_file: str = "heights.csv",
 ) -> List[pd.DataFrame]:
     """
     Extracts wind data from a NetCDF DataFrame for a list of given dates.
 
     Parameters:
     ----------
-    ncdf_df : pd.DataFrame
-        A pandas DataFrame containing the NetCDF data, with a MultiIndex of
-        (date, wind direction).
+    ncdf_df : pd.DataFrame or WindCube
+        The daily wind data, as returned by read_ncdf, with a MultiIndex of
+        (date, wind direction), or a WindCube as returned by read_ncdf_cube,
+        which skips the conversion.
     dates : str or list of str or list of datetime.date
         The date argument to be parsed. Can be one of the following formats:
         - 'YYYY-MM-DD': single date
@@ -135,43 +732,20 @@ def extract_tephra2_wind_data(
         - file path with one date per line
         - list of datetime.date objects
         - list of date strings to be parsed in one of the first three ways.
+    heights_file : str, optional
+        File with the height of each level, one per line.
 
     Returns:
     -------
     List[pd.DataFrame]
         A list of pandas DataFrames containing the wind data for each date in
-        dates.
+        dates. Each DataFrame is a view of extract_tephra2_wind_array's result.
     """
-
-    # Convert datetime objects to date strings in the format required by the
-    # NetCDF DataFrame.
-
-    dates_list = parse_date_arg(dates)
-    date_strings = [date.strftime("%Y-%m-%d") for date in dates_list]
-
-    # Hacking actual heights in here because I don't know how to get them from the
-    # netcdf. I work with what I get.
-    heights = pd.read_csv("heights.csv", header=None)
-
-    # Extract wind data for each date in dates.
-    wind_df_list = []
-    for d in date_strings:
-        # Select wind data for the given date and wind directions.
-        wind_u = ncdf_df.loc[(d, 1), :]
-        wind_v = ncdf_df.loc[(d, 2), :]
-
-        # Compute wind speed and angle from the wind components.
-        speed, angle = get_wind_speed_and_angle(wind_u, wind_v)
-
-        # Create a DataFrame with the wind speed and angle data, indexed by
-        # hour.
-        wind_df = pd.DataFrame(
-            {"Height": heights.values[:, 0], "Speed": speed, "Angle": angle},
-            index=range(1, 38),
-        )
-        wind_df_list += [wind_df]
-
-    return wind_df_list
+    cube = ncdf_df
+    if isinstance(ncdf_df, pd.DataFrame):
+        cube = WindCube.from_dataframe(ncdf_df)
+    winds = extract_tephra2_wind_array(cube, dates, heights_file)
+    return [wind_frame(profile) for profile in winds]
 
 
 def parse_date_arg(date_arg: Union[str, List[Union[str, dt.date]]]) -> List[dt.date]:
@@ -331,17 +905,29 @@ def main():
         help="If set, all files in the date range will be aggregated"
         + " using the mean to a single output file.",
     )
+    parser.add_argument(
+        "-c",
+        "--cache-dir",
+        type=str,
+        help="Directory for the preprocessed wind cache. If set, the aggregated"
+        + " wind data is read from the cache when the netcdf file has been"
+        + " processed before at the same resolution, and written to it otherwise.",
+    )
 
     args = parser.parse_args()
     dates_expanded = [parse_date_arg(date) for date in args.date]
     dates_list = sum(dates_expanded, [])
 
-    nd = NetCDFWindExtractor(args.netcdf_file)
+    nd = NetCDFWindExtractor(
+        args.netcdf_file,
+        cache_dir=args.cache_dir,
+        time_window=(min(dates_list), max(dates_list)),
+    )
 
     # for date in dates_list:
     #     print(date.strftime('%Y-%m-%d'))
 
-    wind_df_list = extract_tephra2_wind_data(nd.df, dates_list)
+    wind_df_list = extract_tephra2_wind_data(nd.cube, dates_list)
 
     save_to_file(wind_df_list, dates_list, args.output_file, aggregate=args.aggregate)
 
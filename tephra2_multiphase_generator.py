@@ -8,6 +8,8 @@ import numpy as np
 from scipy.stats import norm, fisk
 import datetime as dt
 import logging
+import multiprocessing as mp
+import os
 
 
 def read_multiphase_config(filename):
@@ -15,35 +17,140 @@ def read_multiphase_config(filename):
     return config
 
 
-def exp_per_day(loc, scale):
-    return np.exp(norm.rvs(loc=loc, scale=scale))
+def exp_per_day(loc, scale, rng=None):
+    return np.exp(norm.rvs(loc=loc, scale=scale, random_state=rng))
 
 
-def intexp_repose(k, nexplosions_per_day, a, b):
-    val = np.ceil(fisk.rvs(k, nexplosions_per_day, a) / b)
+def intexp_repose(k, nexplosions_per_day, a, b, size=None, rng=None):
+    val = np.ceil(
+        fisk.rvs(k, nexplosions_per_day, a, size=size, random_state=rng) / b
+    )
     return val
 
 
-def cont_repose(k):
-    val = np.ceil(np.exp(k + norm.rvs()))
+def cont_repose(k, size=None, rng=None):
+    val = np.ceil(np.exp(k + norm.rvs(size=size, random_state=rng)))
     return val
 
 
-def generate_phase_runs(config, phase_config_dir, start_date, wind_file):
+def event_offsets(draw_reposes, phase_length):
+    """
+    Generates the offsets of the events in a phase from the start of the phase.
+
+    The first event happens at the start of the phase, and each following event
+    happens one repose time after the previous one, for as long as it falls inside
+    the phase.
+
+    Parameters
+    ----------
+    draw_reposes : callable
+        Function that takes a size and returns an array of that many repose times.
+    phase_length : float
+        The length of the phase, in the same unit as the repose times.
+
+    Returns
+    -------
+    numpy.ndarray
+        The offsets of all events in the phase, starting with 0.
+    """
+    # Repose times are rounded up to whole units, so there can be at most
+    # ceil(phase_length) events in a phase and one batch is normally enough.
+    batch_size = max(int(np.ceil(phase_length)), 1)
+    offsets = np.zeros(1)
+    while offsets[-1] < phase_length:
+        reposes = draw_reposes(batch_size)
+        offsets = np.concatenate([offsets, offsets[-1] + np.cumsum(reposes)])
+    return offsets[offsets < phase_length]
+
+
+def phase_block(
+    phase_conf, offsets, unit, phase_start, phase, phase_type, rng=None, date_unit="D"
+):
+    """
+    Samples all events of a phase at once and returns them as one DataFrame.
+
+    Parameters
+    ----------
+    phase_conf : common_utils.ConfigTemplate
+        The config template of the phase.
+    offsets : numpy.ndarray
+        Offsets of the events from the start of the phase.
+    unit : str
+        NumPy timedelta unit of the offsets, e.g. "h" or "D".
+    phase_start : datetime.datetime
+        Start date of the phase.
+    phase : int
+        Phase number.
+    phase_type : str
+        Phase type.
+    rng : numpy.random.Generator, optional
+        Random number generator to sample the parameters with.
+    date_unit : str, optional
+        NumPy datetime unit of the DATE column. "D" writes the date of each event
+        (YYYY-MM-DD) and "s" its full timestamp (YYYY-MM-DDTHH:MM:SS).
+        Defaults to "D".
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per event, with DATE, PHASE and PHASE_TYPE columns followed by the
+        sampled Tephra2 parameters.
+    """
+    run_df = common_utils.generate_runs(phase_conf, runs=len(offsets), rng=rng)
+    event_times = np.datetime64(phase_start, "s") + offsets.astype(
+        f"timedelta64[{unit}]"
+    )
+    run_df.insert(0, "PHASE_TYPE", phase_type)
+    run_df.insert(0, "PHASE", phase)
+    run_df.insert(0, "DATE", np.datetime_as_string(event_times, unit=date_unit))
+    return run_df
+
+
+def log_bangs(run_df, phase_start, dur):
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
+    days_in_phase = (
+        pd.to_datetime(run_df.DATE) - pd.Timestamp(phase_start.date())
+    ).dt.days
+    for row, day in zip(run_df.itertuples(index=False), days_in_phase):
+        logging.debug(
+            "BANG"
+            f"\tphase={row.PHASE}"
+            f"\ttype={row.PHASE_TYPE}"
+            f"\tday={day}/{dur}"
+            f"\tdate={row.DATE}"
+            f"\theight={row.PLUME_HEIGHT/1000:.2f}km"
+            f"\tmass={row.ERUPTION_MASS:.2e}kg"
+        )
+
+
+def generate_phase_runs(
+    config,
+    phase_config_dir,
+    start_date,
+    wind_file,
+    timeline=None,
+    seed=None,
+    date_unit="D",
+):
     # custom_functions = importlib.import_module("custom_functions")
 
+    if timeline is None:
+        timeline = common_utils.PhaseTimeline.from_config(config, start_date)
+
+    # Every phase draws from its own child stream, so a phase's events only depend
+    # on the seed and the phase's position in the config.
+    phase_seeds = common_utils.spawn_seeds(seed, len(config))
+
     # Get total duration
-    start_datetime = dt.datetime.strptime(start_date, "%Y-%m-%d")
+    start_datetime = timeline.start.to_pydatetime()
+    end_datetime = timeline.end.to_pydatetime()
 
     total_duration = config["Phase Duration"].sum()
     # Following Quiesence column is parsed as a string because the last value is "END".
     # I'm leaving out the last value and parsing the rest to int.
     total_quiescence = config.iloc[0:-1]["Following Quiescence"].astype(int).sum()
 
-    end_datetime = start_datetime + dt.timedelta(
-        days=int(total_duration + total_quiescence)
-    )
-
     logging.info(
         f"\nTotal Duration: {total_duration} days"
         f"\nTotal Quiescence: {total_quiescence} days"
@@ -56,13 +163,14 @@ def generate_phase_runs(config, phase_config_dir, start_date, wind_file):
     event_list = []
 
     columns = []
-    for i, row in config.iterrows():
+    for (i, row), phase_seed in zip(config.iterrows(), phase_seeds):
         phase_type = row["Phase Type"]
+        rng = common_utils.make_rng(phase_seed)
 
         phase_conf_filename = f"{phase_config_dir}{phase_type}_template.conf"
         if phase_type != "Eff":  # Effusive eruptions don't have config files
             try:
-                phase_conf = common_utils.read_config_file(phase_conf_filename)
+                phase_conf = common_utils.load_config_template(phase_conf_filename)
                 if len(columns) == 0:
                     columns = ["DATE"]
                     columns += phase_conf.keys()
@@ -74,11 +182,8 @@ def generate_phase_runs(config, phase_config_dir, start_date, wind_file):
                 sys.exit(0)
         dur = row["Phase Duration"]
         qui = row["Following Quiescence"]
-        tot_dur = config.iloc[0:i]["Phase Duration"].sum()
-        tot_qui = config.iloc[0:i]["Following Quiescence"].astype(int).sum()
-
-        phase_start = start_datetime + dt.timedelta(days=float(tot_dur + tot_qui))
-        phase_end = phase_start + dt.timedelta(days=(row["Phase Duration"]))
+        phase_start = timeline.phase_start(i).to_pydatetime()
+        phase_end = timeline.phase_end(i).to_pydatetime()
         phase_start_str = phase_start.strftime("%Y-%m-%d")
         phase_end_str = phase_end.strftime("%Y-%m-%d")
         logging.info(
@@ -93,93 +198,169 @@ def generate_phase_runs(config, phase_config_dir, start_date, wind_file):
             "\n..."
         )
         bangs = 0
+        phase_length = phase_end - phase_start
+        run_df = None
         if (phase_type == "IntExp") or (phase_type == "Eff+Exp"):
-            nexpday = exp_per_day(-0.4772, 1.92)  # Hardcoded K
-
-            phase_day = phase_start
-
-            while phase_day < phase_end:
-                bangs += 1
-                repose_hours = intexp_repose(4, nexpday, 1, 24)
-                run_df = common_utils.generate_runs(phase_conf)
-                run_df.insert(0, "PHASE_TYPE", [phase_type])
-                run_df.insert(0, "PHASE", [i])
-                run_df.insert(0, "DATE", [phase_day.strftime("%Y-%m-%d")])
-                event_list += [run_df]
-                days_in_phase = (phase_day - phase_start).days
-                logging.debug(
-                    "BANG"
-                    f"\tphase={run_df.PHASE[0]}"
-                    f"\ttype={run_df.PHASE_TYPE[0]}"
-                    f"\tday={days_in_phase}/{dur}"
-                    f"\tdate={run_df.DATE[0]}"
-                    f"\theight={run_df.PLUME_HEIGHT[0]/1000:.2f}km"
-                    f"\tmass={run_df.ERUPTION_MASS[0]:.2e}kg"
-                )
-                phase_day += dt.timedelta(hours=float(repose_hours))
+            nexpday = exp_per_day(-0.4772, 1.92, rng=rng)  # Hardcoded K
+
+            offsets = event_offsets(
+                lambda size: intexp_repose(4, nexpday, 1, 24, size=size, rng=rng),
+                phase_length / dt.timedelta(hours=1),
+            )
+            run_df = phase_block(
+                phase_conf, offsets, "h", phase_start, i, phase_type, rng, date_unit
+            )
 
         elif phase_type == "CtsExp":
-            phase_day = phase_start
-
-            while phase_day < phase_end:
-                bangs += 1
-                repose = cont_repose(2.37)  # Hardcoded k value for Cont. eruptions
-                run_df = common_utils.generate_runs(phase_conf)
-                run_df.insert(0, "PHASE_TYPE", [phase_type])
-                run_df.insert(0, "PHASE", [i])
-                run_df.insert(0, "DATE", [phase_day.strftime("%Y-%m-%d")])
-                event_list += [run_df]
-                days_in_phase = (phase_day - phase_start).days
-                logging.debug(
-                    "BANG"
-                    f"\tphase={run_df.PHASE[0]}"
-                    f"\ttype={run_df.PHASE_TYPE[0]}"
-                    f"\tday={days_in_phase}/{dur}"
-                    f"\tdate={run_df.DATE[0]}"
-                    f"\theight={run_df.PLUME_HEIGHT[0]/1000:.2f}km"
-                    f"\tmass={run_df.ERUPTION_MASS[0]:.2e}kg"
-                )
-                phase_day += dt.timedelta(days=float(repose))
+            offsets = event_offsets(
+                # Hardcoded k value for Cont. eruptions
+                lambda size: cont_repose(2.37, size=size, rng=rng),
+                phase_length / dt.timedelta(days=1),
+            )
+            run_df = phase_block(
+                phase_conf, offsets, "D", phase_start, i, phase_type, rng, date_unit
+            )
 
         else:
             if phase_type != "Eff":  # Effusive eruptions don't do anything
-                phase_day = phase_start
-
-                phase_length = phase_end - phase_start
-
                 phase_days = phase_length.days
-                base_run = common_utils.generate_runs(phase_conf)
-                while phase_day < phase_end:
-                    bangs += 1
-                    run_df = base_run.copy()
-                    run_df.insert(0, "PHASE_TYPE", [phase_type])
-                    run_df.insert(0, "PHASE", [i])
-                    run_df.insert(0, "DATE", [phase_day.strftime("%Y-%m-%d")])
-
-                    run_df.loc[0, "ERUPTION_MASS"] = (
-                        run_df.ERUPTION_MASS[0] / phase_days
-                    )
-                    event_list += [run_df]
-                    days_in_phase = (phase_day - phase_start).days
-                    logging.debug(
-                        "BANG"
-                        f"\tphase={run_df.PHASE[0]}"
-                        f"\ttype={run_df.PHASE_TYPE[0]}"
-                        f"\tday={days_in_phase}/{dur}"
-                        f"\tdate={run_df.DATE[0]}"
-                        f"\theight={run_df.PLUME_HEIGHT[0]/1000:.2f}km"
-                        f"\tmass={run_df.ERUPTION_MASS[0]:.2e}kg"
-                    )
-                    phase_day += dt.timedelta(days=1)
+                base_run = common_utils.generate_runs(phase_conf, rng=rng)
+
+                # One event per day, each with an equal share of the mass.
+                offsets = np.arange(np.ceil(phase_length / dt.timedelta(days=1)))
+                run_df = base_run.loc[np.zeros(len(offsets), dtype=int)]
+                run_df = run_df.reset_index(drop=True)
+                run_df["ERUPTION_MASS"] = run_df["ERUPTION_MASS"] / phase_days
+                event_times = np.datetime64(phase_start, "s") + offsets.astype(
+                    "timedelta64[D]"
+                )
+                run_df.insert(0, "PHASE_TYPE", phase_type)
+                run_df.insert(0, "PHASE", i)
+                run_df.insert(
+                    0, "DATE", np.datetime_as_string(event_times, unit=date_unit)
+                )
+
+        if run_df is not None:
+            bangs = len(run_df)
+            event_list += [run_df]
+            log_bangs(run_df, phase_start, dur)
         logging.info(f"\nDONE. Generated {bangs} bangs over {dur} days.\n")
         if qui != "END":
             logging.info(f"\n........QUIESCENT for {qui} days........")
     logging.info("Preparing dataframe for export...")
-    ret_df = pd.concat(event_list, axis=0)
+    ret_df = pd.concat(event_list, axis=0, ignore_index=True)
     logging.info("DONE.")
     return ret_df
 
 
+def _init_realisation_worker(log_level):
+    # Per-phase progress from many workers at once is unreadable, so workers only
+    # report warnings unless debug output was requested.
+    if log_level != logging.DEBUG:
+        logging.getLogger().setLevel(max(log_level, logging.WARNING))
+
+
+def _generate_realisation(task):
+    realisation, args = task
+    run_df = generate_phase_runs(*args)
+    run_df.insert(0, "REALISATION", realisation)
+    return run_df
+
+
+def generate_realisations(
+    config,
+    phase_config_dir,
+    start_date,
+    wind_file,
+    realisations,
+    timeline=None,
+    seed=None,
+    workers=None,
+    date_unit="D",
+    output_file=None,
+):
+    """
+    Generates independent realisations of the eruption sequence in a process pool.
+
+    Parameters
+    ----------
+    config : pandas.DataFrame
+        The multiphase configuration.
+    phase_config_dir : str
+        Directory containing the phase config templates.
+    start_date : str
+        Start date of phase 0 in YYYY-MM-DD format.
+    wind_file : str
+        Path to the wind file.
+    realisations : int
+        Number of realisations to generate.
+    timeline : common_utils.PhaseTimeline, optional
+        Timeline of the configuration. Computed from config if not given.
+    seed : None, int or numpy.random.SeedSequence, optional
+        Seed of the ensemble. Realisation r draws from the r-th child stream of
+        this seed, so each realisation is reproducible on its own.
+    workers : int, optional
+        Number of worker processes. Defaults to os.cpu_count().
+    date_unit : str, optional
+        NumPy datetime unit of the DATE column, see phase_block.
+    output_file : str, optional
+        CSV file to write the events to. If given, each realisation is appended
+        to it as soon as it is generated, in realisation order, so that only the
+        realisations still being generated are held in memory.
+
+    Returns
+    -------
+    pandas.DataFrame or int
+        The events of all realisations, sorted by realisation, with a leading
+        REALISATION column holding the realisation id. If ``output_file`` is
+        given, the number of events written to it instead.
+    """
+    if timeline is None:
+        timeline = common_utils.PhaseTimeline.from_config(config, start_date)
+
+    tasks = [
+        (
+            r,
+            (
+                config,
+                phase_config_dir,
+                start_date,
+                wind_file,
+                timeline,
+                r_seed,
+                date_unit,
+            ),
+        )
+        for r, r_seed in enumerate(common_utils.spawn_seeds(seed, realisations))
+    ]
+
+    df_list = []
+    n_events = 0
+    with mp.Pool(
+        processes=workers or os.cpu_count(),
+        initializer=_init_realisation_worker,
+        initargs=(logging.getLogger().getEffectiveLevel(),),
+    ) as pool:
+        for r, run_df in enumerate(pool.imap(_generate_realisation, tasks)):
+            logging.info(
+                f"Realisation {run_df.REALISATION.iloc[0]}: generated {len(run_df)}"
+                " bangs."
+            )
+            if output_file is None:
+                df_list += [run_df]
+                continue
+            # imap yields in task order, so the file starts with realisation 0
+            first = r == 0
+            run_df.to_csv(
+                output_file, mode="w" if first else "a", header=first, index=False
+            )
+            n_events += len(run_df)
+
+    if output_file is not None:
+        return n_events
+    return pd.concat(df_list, axis=0, ignore_index=True)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Generate Tephra2 input files for multiple eruption phases."
@@ -227,6 +408,47 @@ def main():
             " current working directory."
         ),
     )
+    parser.add_argument(
+        "-s",
+        "--seed",
+        type=int,
+        help=(
+            "seed for the random number generator. Runs with the same seed and"
+            " inputs generate identical output. If not specified, a random seed is"
+            " used and logged."
+        ),
+    )
+    parser.add_argument(
+        "-n",
+        "--realisations",
+        type=int,
+        default=1,
+        help=(
+            "number of independent realisations of the eruption sequence to"
+            " generate. If more than one, all realisations are written to the"
+            " output file with a leading REALISATION column. Defaults to 1."
+        ),
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help=(
+            "number of worker processes used to generate realisations. Defaults to"
+            " the number of CPUs."
+        ),
+    )
+    parser.add_argument(
+        "-t",
+        "--event-times",
+        action="store_true",
+        help=(
+            "write the full timestamp of each event (YYYY-MM-DDTHH:MM:SS) to the"
+            " DATE column, and not only its date. Use this to run Tephra2 with"
+            " sub-daily wind data."
+        ),
+    )
     log_group = parser.add_mutually_exclusive_group()
     log_group.add_argument(
         "-q", "--quiet", action="store_true", help="Suppress all output"
@@ -254,21 +476,60 @@ def main():
     config = read_multiphase_config(args.config_file)
     logging.info("DONE.")
 
-    mp_df = generate_phase_runs(
-        config, args.phase_config_dir, args.start_date, args.wind_file
-    )
+    timeline = common_utils.PhaseTimeline.from_config(config, args.start_date)
+
+    seed = np.random.SeedSequence(args.seed)
+    logging.info(f"Random seed: {seed.entropy}")
+
+    date_unit = "s" if args.event_times else "D"
 
     if args.output:
-        logging.info(f'Saving to file "{args.output}"...')
-        mp_df.to_csv(args.output, index=False)
-        logging.info("DONE.")
+        output_file = args.output
+        logging.info(f'Saving to file "{output_file}"...')
     else:
+        output_file = "output.csv"
         logging.info(
             "No output file/directory specified."
             '\nSaving with default filename "output.csv" to current directory...'
         )
-        mp_df.to_csv("output.csv", index=False)
-        logging.info("DONE.")
+
+    if args.realisations > 1:
+        logging.info(
+            f"Generating {args.realisations} realisations with {args.workers}"
+            " workers..."
+        )
+        # Realisations are written as they are generated
+        generate_realisations(
+            config,
+            args.phase_config_dir,
+            args.start_date,
+            args.wind_file,
+            args.realisations,
+            timeline,
+            seed,
+            args.workers,
+            date_unit,
+            output_file,
+        )
+    else:
+        # A single realisation draws from the first child stream too, so that it
+        # equals realisation 0 of a run with more realisations and the same seed.
+        mp_df = generate_phase_runs(
+            config,
+            args.phase_config_dir,
+            args.start_date,
+            args.wind_file,
+            timeline,
+            common_utils.spawn_seeds(seed, 1)[0],
+            date_unit,
+        )
+        mp_df.to_csv(output_file, index=False)
+    logging.info("DONE.")
+
+    timeline_file = common_utils.timeline_filename(output_file)
+    logging.info(f'Saving phase timeline to file "{timeline_file}"...')
+    timeline.to_csv(timeline_file)
+    logging.info("DONE.")
 
     logging.info("Script success. Exiting.")
 
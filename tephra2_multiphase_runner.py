@@ -1,17 +1,45 @@
 import os
 import argparse
+import atexit
 import subprocess
 from datetime import datetime
-from netcdf_wind_extractor import NetCDFWindExtractor
+from netcdf_wind_extractor import (
+    NATIVE,
+    NetCDFWindExtractor,
+    bin_width,
+    file_hash,
+    wind_frame,
+)
+import common_utils
 import logging
 import time
-import sys
-import re
 import multiprocessing as mp
 import h5py
 import pandas as pd
 import numpy as np
 import shutil
+import tempfile
+import hashlib
+import json
+import re
+from collections import Counter, OrderedDict
+from functools import lru_cache, partial
+
+# Name of the mass load column of Tephra2 output
+LOAD_COLUMN = "Kg/m^2"
+
+# Matches the names of the phi class columns of Tephra2 output, e.g. [-7->-6)
+PHI_INTERVAL_REGEX = re.compile(
+    r"\[[-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?->[-+]?[0-9]*"
+    + r"\.?[0-9]+(?:[eE][-+]?[0-9]+)?\)"
+)
+
+# Tephra2 parameter the deposit load is proportional to
+MASS_COLUMN = "ERUPTION_MASS"
+
+# Parameters the run time of Tephra2 scales with, used to schedule the longest
+# simulations first
+COST_COLUMNS = ["PLUME_HEIGHT", "COL_STEPS", "PART_STEPS"]
 
 
 def validate_input_files(multiphase_config_file, netcdf_file, grid_file, tephra2_path):
@@ -38,135 +66,1001 @@ def validate_input_files(multiphase_config_file, netcdf_file, grid_file, tephra2
         raise ValueError("Tephra2 path is invalid or not executable.")
 
 
-def export_to_hdf(
-    output_df_list, config_file_list, wind_file_list, grid_file, out_file, phases
-):
-    """Export Tephra2 simulations to binary HDF (.h5) format.
+class WindStore:
+    """Content-addressed store of the wind profiles used by a run.
+
+    Each distinct profile is written to a Tephra2 wind file once, named after the
+    SHA-256 hash of its contents, and kept in memory for the HDF export. Wind time
+    steps with identical profiles share one file.
 
     Parameters
     ----------
-    df_list : List of Tephra2 outputs as Pandas DataFrames.
-    param_tuple : List of tuples of parameters of tephra2 sims.
+    directory : str
+        Directory the Tephra2 wind files are written to.
+    """
 
-    Returns
-    -------
-    None
+    def __init__(self, directory):
+        self.directory = directory
+        self.digests = {}
+        self.profiles = {}
+        self.files = {}
+
+    def add(self, wind_key, profile):
+        """Adds the (n_levels, 3) wind profile of the time step ``wind_key``.
+
+        Returns the hash of the profile.
+        """
+        profile = np.ascontiguousarray(profile, dtype=np.float64)
+        digest = hashlib.sha256(profile.tobytes()).hexdigest()
+        self.digests[wind_key] = digest
+        if digest not in self.files:
+            wind_filename = os.path.join(self.directory, f"wind_{digest[:16]}.dat")
+            logging.debug(f"Writing wind data for {wind_key} to {wind_filename}")
+            wind_frame(profile).to_csv(
+                wind_filename, sep=" ", header=False, index=False
+            )
+            self.profiles[digest] = profile
+            self.files[digest] = wind_filename
+        return digest
+
+    def filename(self, wind_key):
+        """Returns the Tephra2 wind file of the time step ``wind_key``."""
+        return self.files[self.digests[wind_key]]
+
+    def profile(self, wind_key):
+        """Returns the wind profile of the time step ``wind_key``."""
+        return self.profiles[self.digests[wind_key]]
+
+    def __len__(self):
+        return len(self.files)
+
+
+def read_grid_lines(grid_file):
+    """Returns the header comment lines and the point lines of a grid file."""
+    with open(grid_file, "r") as f:
+        lines = f.readlines()
+    header = [line for line in lines if line.startswith("#")]
+    points = [line for line in lines if line.strip() and not line.startswith("#")]
+    return header, points
+
+
+class GridTiles:
+    """Spatial tiles of a grid file, and the stitching of their Tephra2 outputs.
+
+    The grid points are sorted by their first and second coordinates and cut into
+    ``n_tiles`` bands of about equal size. Each band is written to its own grid
+    file, so that one simulation can be run as several Tephra2 tasks, one per
+    tile. Tile outputs are stitched back into the order of the grid file.
 
+    Parameters
+    ----------
+    grid_file : str
+        Grid file.
+    n_tiles : int
+        Number of tiles. With a single tile, the grid file itself is used.
+    directory : str
+        Directory the tile grid files are written to.
     """
 
-    filename = f"{out_file}_phase{int(phases[0]):03d}.h5"
-    logging.info(f"Exporting data to {filename} ...")
-    f = h5py.File(filename, "w")
+    def __init__(self, grid_file, n_tiles, directory):
+        header, points = read_grid_lines(grid_file)
+        self.n_points = len(points)
+        if n_tiles == 1:
+            self.files = [grid_file]
+            self.nodes = [np.arange(self.n_points)]
+        else:
+            coords = np.loadtxt(points, ndmin=2)
+            order = np.lexsort((coords[:, 1], coords[:, 0]))
+            self.nodes = [np.sort(nodes) for nodes in np.array_split(order, n_tiles)]
+            self.files = []
+            for tile, nodes in enumerate(self.nodes):
+                tile_file = os.path.join(directory, f"grid_tile{tile:03d}.csv")
+                with open(tile_file, "w") as f:
+                    f.writelines(header + [points[node] for node in nodes])
+                self.files += [tile_file]
+        self.pending = {}
 
-    # Extract non-unique dates from wind filenames
-    date_list = [
-        re.search(r"(\d{4}-\d{2}-\d{2})", wind_file).group()
-        for wind_file in wind_file_list
-    ]
-    # Drop duplicate wind files
-    wind_file_list = list(set(wind_file_list))
-    wind_col_names = ["Elevation", "Speed", "Direction"]
-    logging.info(f"Exporting wind data between {date_list[0]} and {date_list[-1]}")
-    wind_group = f.create_group("wind")
-    unique_dates = []
-    for wind_file in wind_file_list:
-        # Extract unique date for wind entry
-        wind_date = re.search(r"(\d{4}-\d{2}-\d{2})", wind_file).group()
-        # Save the unique dates for later
-        unique_dates += [wind_date]
-        # Read wind csv into dataframe
-        wind_df = pd.read_csv(wind_file, sep=" ", names=wind_col_names, header=None)
-        logging.debug(f"Writing wind data for {wind_date}")
-        # Convert dataframe to numpy records array
-        wind_rec_arr = wind_df.to_records(index=False)
-        # Insert wind into HDF table
-        wind_group.create_dataset(f"wind_{wind_date}", data=wind_rec_arr)
-        # Delete wind temp file ACTUALLY DON'T DO THIS i think
-        # os.remove(wind_file)
-
-    # Just adding the grid file to root because we only use one.
-    logging.info("Exporting simulation grid coordinates")
-    grid_col_names = ["Northing", "Easting", "Elevation"]
-    grid_df = pd.read_csv(
-        grid_file,
-        sep=" ",
-        names=grid_col_names,
-        header=None,
-        comment="#",
-        dtype=np.float64,
-    )
-    grid_rec_arr = grid_df.to_records(index=False)
-    f.create_dataset("grid", data=grid_rec_arr)
-
-    logging.info("Exporting simulation input and output data")
-    sim_group = f.create_group("sims")
-    config_group = f.create_group("configs")
-    i = 0
-    intervals = None
-    # Aggregate by day.
-    # This doesn't work for any other time resolution.
-    for date in unique_dates:
-        # find indexes of all dates in date_list that are like date.
-        date_idxs = [i for i in range(len(date_list)) if date_list[i] == date]
-        logging.debug(f"Aggregating all simulations for {date}")
-        agg_df = None
-        config_refs_in_phase = []
-        for di in date_idxs:
-            i += 1
-            output_df = output_df_list[di]
-            config_file = config_file_list[di]
-
-            wind_ref = wind_group[f"wind_{date}"].ref
-            logging.debug(f"Writing config data for Sim {i} on {date}")
-            config_df = pd.read_csv(
-                config_file, sep="\t", index_col=0, names=[None, 0]
-            ).T
-            config_rec_arr = config_df.to_records(index=False)
-            config_dset = config_group.create_dataset(
-                f"config_{i}", data=config_rec_arr
+    def __len__(self):
+        return len(self.files)
+
+    def add(self, task_id, tile, output, error=None):
+        """Adds the output of one tile of simulation ``task_id``.
+
+        Returns None until all tiles of the simulation are in. Then returns the
+        stitched output and None, or None and the errors of the failed tiles.
+        """
+        parts, errors = self.pending.setdefault(task_id, ({}, []))
+        if error is None:
+            parts[tile] = output
+        else:
+            errors += [f"tile {tile}: {error}"]
+        if len(parts) + len(errors) < len(self):
+            return None
+        del self.pending[task_id]
+        if errors:
+            return None, "; ".join(errors)
+        header = parts[0][0]
+        data = np.empty((self.n_points, len(header[0])))
+        for tile, (tile_header, tile_data) in parts.items():
+            if tile_header[0] != header[0]:
+                return None, f"tile {tile}: output columns differ from tile 0"
+            if len(tile_data) != len(self.nodes[tile]):
+                return None, (
+                    f"tile {tile}: {len(tile_data)} output rows for"
+                    f" {len(self.nodes[tile])} grid points"
+                )
+            data[self.nodes[tile]] = tile_data
+        return (header, data), None
+
+
+class GridMask:
+    """Adaptive masking of a grid, from a coarse pilot run of each simulation.
+
+    Every ``stride``-th point along both axes of the grid is part of the pilot
+    grid. Each simulation is first run on the pilot grid. The other points are
+    then only computed near the deposit found by the pilot run: a point is
+    computed if a pilot point of its pilot cell, or of one of the eight cells
+    around it, has a load above ``threshold``. The points that are not computed
+    are left out of the output, and count as zero load.
+
+    Points are placed on the pilot lattice by the rank of their coordinates, so
+    the grid is expected to be regular, like those of generate_utm_grid.py.
+
+    Parameters
+    ----------
+    grid_file : str
+        Grid file.
+    stride : int
+        Spacing of the pilot grid, in grid points.
+    threshold : float
+        Load in kg/m^2 up to which a pilot point counts as no deposit.
+    directory : str
+        Directory the grid files of the pilot and of the computed points are
+        written to.
+    """
+
+    def __init__(self, grid_file, stride, threshold, directory):
+        if stride < 1:
+            raise ValueError(f"Pilot grid stride must be at least 1, not {stride}.")
+        self.header, self.points = read_grid_lines(grid_file)
+        self.n_points = len(self.points)
+        self.threshold = threshold
+        coords = np.loadtxt(self.points, ndmin=2)
+        ranks = [
+            np.unique(coords[:, axis], return_inverse=True)[1].ravel()
+            for axis in (0, 1)
+        ]
+        self.cells = tuple(rank // stride for rank in ranks)
+        self.shape = tuple(int(cell.max()) + 1 for cell in self.cells)
+        pilot = (ranks[0] % stride == 0) & (ranks[1] % stride == 0)
+        self.pilot_nodes = np.flatnonzero(pilot)
+        self.file = os.path.join(directory, "grid_pilot.csv")
+        with open(self.file, "w") as f:
+            f.writelines(self.header + [self.points[node] for node in self.pilot_nodes])
+
+    def select(self, pilot_load):
+        """Returns the indexes of the points to compute, given the pilot loads.
+
+        Pilot points are not included, as they are computed already.
+        """
+        hot = np.zeros(self.shape, dtype=bool)
+        hot[tuple(cell[self.pilot_nodes] for cell in self.cells)] = (
+            pilot_load > self.threshold
+        )
+        padded = np.pad(hot, 1)
+        near = np.zeros_like(hot)
+        for d0 in range(3):
+            for d1 in range(3):
+                near |= padded[d0 : d0 + self.shape[0], d1 : d1 + self.shape[1]]
+        selected = near[self.cells]
+        selected[self.pilot_nodes] = False
+        return np.flatnonzero(selected)
+
+    def run(self, task_args, timeout=None):
+        """Runs a simulation on the pilot grid, then on the points near its deposit.
+
+        ``task_args`` are the arguments of run_tephra2, with the pilot grid file
+        as grid file. The grid file of the computed points is written next to the
+        Tephra2 configuration file, and removed after the run.
+
+        Returns
+        -------
+        tuple
+            The parsed header, the output of the computed points, sorted by
+            point, and the indexes of those points in the grid.
+        """
+        result, _ = run_tephra2(*task_args, timeout=timeout)
+        header, data = read_tephra2_output(result.stdout, len(self.pilot_nodes))
+        nodes = self.select(data[:, header[2]])
+        if len(nodes) == 0:
+            return header, data, self.pilot_nodes
+        grid_file = os.path.splitext(task_args[1])[0] + "_grid.csv"
+        with open(grid_file, "w") as f:
+            f.writelines(self.header + [self.points[node] for node in nodes])
+        try:
+            result, _ = run_tephra2(
+                task_args[0], task_args[1], grid_file, *task_args[3:], timeout=timeout
             )
-            config_dset.attrs.create("phase", phases[0])
-            config_dset.attrs.create("phase type", phases[1])
-            config_dset.attrs["date"] = date
-            config_dset.attrs["wind"] = wind_ref
-            config_ref = config_dset.ref
-            config_refs_in_phase += [config_ref]
-            logging.debug(f"Aggregating data for Sim {i} on {date}")
-            for col in output_df:
-                output_df[col] = pd.to_numeric(output_df[col], errors="coerce")
-            if agg_df is None:
-                agg_df = output_df
-            else:
-                if intervals is None:
-                    # Find all phi class columns
-                    intervals = agg_df.filter(
-                        regex=(
-                            r"\[[-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?->[-+]?[0-9]*"
-                            + r"\.?[0-9]+(?:[eE][-+]?[0-9]+)?\)"
-                        )
-                    ).columns.tolist()
-                # aggregate phi_class columns
-                agg_df[intervals] = agg_df[intervals].add(output_df[intervals])
-
-                # normalise all phi class columns to add up to 100
-                agg_df[intervals] = (
-                    agg_df[intervals].div(agg_df[intervals].sum(axis=1), axis=0) * 100
+        finally:
+            os.remove(grid_file)
+        fine_header, fine_data = read_tephra2_output(result.stdout, len(nodes))
+        if fine_header[0] != header[0]:
+            raise ValueError("Output of the masked grid does not match the pilot.")
+        nodes = np.concatenate((self.pilot_nodes, nodes))
+        order = np.argsort(nodes)
+        return header, np.concatenate((data, fine_data))[order], nodes[order]
+
+
+# Grid mask of the run, set in each worker process by init_worker
+_grid_mask = None
+
+
+def init_worker(grid_mask=None):
+    """Initialises a worker process with the grid mask of the run, if any.
+
+    The mask is passed once per worker, not with every task.
+    """
+    global _grid_mask
+    _grid_mask = grid_mask
+
+
+def result_key(params, param_names, wind_digest, setup):
+    """Returns the result cache key of a simulation.
+
+    The key is the SHA-256 hash of the Tephra2 parameters other than
+    ERUPTION_MASS, the SHA-256 hash of the wind profile, and ``setup``, a hash of
+    the grid file and the Tephra2 executable. Simulations that only differ in
+    eruption mass share a key.
+    """
+    keep = [name != MASS_COLUMN for name in param_names]
+    sha = hashlib.sha256(f"{setup}:{wind_digest}:".encode())
+    sha.update(",".join(np.array(param_names)[keep]).encode())
+    sha.update(np.asarray(params, dtype="<f8")[keep].tobytes())
+    return sha.hexdigest()
+
+
+def bin_height(height, tolerance):
+    """Rounds a plume height to the nearest of a geometric sequence of heights.
+
+    Consecutive heights of the sequence differ by a factor of 1 + ``tolerance``,
+    so a height moves by at most about half the tolerance, relative to itself.
+    Heights that are not positive are returned unchanged.
+    """
+    if height <= 0:
+        return height
+    step = np.log1p(tolerance)
+    return float(np.exp(np.round(np.log(height) / step) * step))
+
+
+def scale_tephra2_output(output, factor):
+    """Returns a copy of a parsed Tephra2 output, with its load times ``factor``.
+
+    The grain size fractions do not depend on the eruption mass, and are kept.
+    """
+    header, data = output[:2]
+    data = data.copy()
+    data[:, header[2]] *= factor
+    return (header, data, *output[2:])
+
+
+class ResultCache:
+    """On-disk cache of Tephra2 outputs per unit eruption mass, with LRU eviction.
+
+    The load of Tephra2 output is proportional to ERUPTION_MASS, and its grain
+    size fractions do not depend on it. Outputs are stored with their load
+    divided by the eruption mass, as .npz files named after their result_key,
+    and scaled to the mass of each simulation they are reused for. Entries are
+    written to a temporary file and moved into place, so an interrupted write
+    never leaves a partial entry behind.
+
+    Reading an entry marks it as recently used, by its modification time. The
+    least recently used entries are removed once the cache grows beyond
+    ``max_size`` bytes.
+
+    Parameters
+    ----------
+    directory : str
+        Cache directory, created if needed.
+    max_size : int, optional
+        Maximum total size of the entries in bytes. No limit if None.
+    """
+
+    def __init__(self, directory, max_size=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_size = max_size
+        entries = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".npz") and ".tmp" not in entry.name:
+                stat = entry.stat()
+                entries += [(stat.st_mtime, entry.name[:-4], stat.st_size)]
+        # Sizes of the entries, from the least to the most recently used
+        self.entries = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self.size = sum(self.entries.values())
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _filename(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def get(self, key, mass):
+        """Returns the output of ``key`` scaled to ``mass``, or None if not cached."""
+        if key not in self.entries:
+            return None
+        filename = self._filename(key)
+        try:
+            output = load_tephra2_output(filename)
+            os.utime(filename)
+        except OSError:
+            # Removed by another run sharing the cache
+            self.size -= self.entries.pop(key)
+            return None
+        self.entries.move_to_end(key)
+        return scale_tephra2_output(output, mass)
+
+    def put(self, key, output, mass):
+        """Stores the output of a simulation of eruption mass ``mass`` as ``key``."""
+        filename = self._filename(key)
+        tmp_filename = f"{filename[:-4]}.tmp{os.getpid()}.npz"
+        save_tephra2_output(tmp_filename, scale_tephra2_output(output, 1 / mass))
+        os.replace(tmp_filename, filename)
+        size = os.path.getsize(filename)
+        self.size += size - self.entries.pop(key, 0)
+        self.entries[key] = size
+        while self.max_size is not None and self.size > self.max_size:
+            old_key, old_size = self.entries.popitem(last=False)
+            self.size -= old_size
+            if os.path.exists(self._filename(old_key)):
+                os.remove(self._filename(old_key))
+            if old_key == key:
+                break
+
+
+def phase_key(phase, realisation=None):
+    """Returns the name of a phase, e.g. "phase003" or "real0001_phase003"."""
+    key = f"phase{int(phase):03d}"
+    if realisation is not None:
+        key = f"real{int(realisation):04d}_{key}"
+    return key
+
+
+class PhaseAggregator:
+    """Aggregates the Tephra2 outputs of one phase by date as they complete.
+
+    Each output is folded into the running sums of its date as soon as it arrives,
+    so only the sums of each date are held in memory, and not every output of the
+    phase. The load of a date is the sum of the loads of its simulations, and its
+    grain size distribution is the mean of theirs weighted by load. The sums do
+    not depend on the order the outputs arrive in.
+
+    Once all simulations of a date are in, the date is added to ``ready``, to be
+    taken out with pop and written, so that only the dates still being simulated
+    are held in memory.
+
+    Parameters
+    ----------
+    phases : tuple
+        Phase number and phase type.
+    dates : list of str
+        Date of the event of each simulation in the phase, as YYYY-MM-DD.
+    realisation : int, optional
+        Realisation the phase belongs to, for multiphase configuration files with
+        several realisations.
+    n_points : int, optional
+        Number of grid points. Needed for the outputs of masked grids, which only
+        hold the points that were computed.
+    """
+
+    def __init__(self, phases, dates, realisation=None, n_points=None):
+        self.phases = phases
+        self.realisation = realisation
+        self.n_points = n_points
+        self.remaining = len(dates)
+        # Simulations still to come in on each date
+        self.expected = Counter(dates)
+        # Dates whose simulations are all in, in the order they completed
+        self.ready = []
+        self.n_sims = 0
+        # Temporary files of the phase, removed in one batch once it is written
+        self.temp_files = []
+        self.header = None
+        self.aggregates = {}
+        self.weighted = {}
+        self.counts = {}
+        # Number of simulations that computed each point on each date, for the
+        # outputs of masked grids
+        self.computed = {}
+        self.sims = {}
+        self.failed = []
+
+    def _count(self, date):
+        self.remaining -= 1
+        self.expected[date] -= 1
+        if self.expected[date] == 0 and date in self.aggregates:
+            self.ready += [date]
+
+    def fail(self, task_id, date):
+        """Counts simulation ``task_id`` as failed, leaving it out of the aggregates."""
+        self.failed += [task_id]
+        self._count(date)
+
+    @property
+    def key(self):
+        """Name of the phase, see phase_key."""
+        return phase_key(self.phases[0], self.realisation)
+
+    @property
+    def done(self):
+        """True once the outputs of all simulations of the phase were added."""
+        return self.remaining == 0
+
+    def add(self, task_id, output, params, date, wind_key):
+        """Folds the output of simulation ``task_id`` into the aggregate of its date.
+
+        ``output`` is the (header, data) tuple returned by read_tephra2_output, or
+        the (header, data, nodes) tuple of a masked grid, and ``params`` the
+        Tephra2 parameter values of the simulation.
+        ``date`` is the date of the event, as YYYY-MM-DD, and ``wind_key`` the
+        time step of the wind it was run with, which may fall on another date.
+        """
+        header, data = output[:2]
+        if self.header is None:
+            self.header = header
+        elif header[0] != self.header[0]:
+            raise ValueError(
+                f"Tephra2 output columns of simulation {task_id} differ from those of"
+                " the other simulations of the phase."
+            )
+        _, intervals, load = self.header
+        nodes = None
+        if len(output) > 2:
+            # Points that were not computed get zero load
+            nodes = output[2]
+            data = np.zeros((self.n_points, data.shape[1]))
+            data[nodes] = output[1]
+            self.computed.setdefault(date, np.zeros(self.n_points, dtype=int))
+            self.computed[date][nodes] += 1
+        # Sum of the phi class fractions weighted by the load at each point
+        weighted = data[:, intervals] * data[:, load, None]
+        agg = self.aggregates.get(date)
+        if agg is None:
+            self.aggregates[date] = data
+            self.weighted[date] = weighted
+            self.counts[date] = 1
+        else:
+            # Unweighted sum of the phi class fractions, used where no simulation
+            # deposits anything
+            agg[:, intervals] += data[:, intervals]
+            # aggregate mass in mass/area column
+            agg[:, load] += data[:, load]
+            if nodes is not None:
+                # Coordinates of the points only computed by this simulation
+                fixed = np.setdiff1d(np.arange(data.shape[1]), [*intervals, load])
+                agg[np.ix_(nodes, fixed)] = output[1][:, fixed]
+            self.weighted[date] += weighted
+            self.counts[date] += 1
+        self.sims.setdefault(date, []).append((task_id, params, wind_key))
+        self.n_sims += 1
+        self._count(date)
+
+    def aggregate(self, date):
+        """Returns the aggregated output of all simulations on ``date``.
+
+        The output is an array of shape (n_points, n_columns), with the columns of
+        the Tephra2 output.
+        """
+        _, intervals, load = self.header
+        agg = self.aggregates[date]
+        if self.counts[date] > 1:
+            # Load-weighted mean of the phi class fractions, which add up to 100
+            # like those of each simulation. Points without any load get the
+            # unweighted mean, over the simulations that computed them for
+            # masked grids.
+            total = agg[:, load, None]
+            count = self.counts[date]
+            if date in self.computed:
+                count = np.maximum(self.computed[date], 1)[:, None]
+            mean = agg[:, intervals] / count
+            with np.errstate(invalid="ignore", divide="ignore"):
+                agg[:, intervals] = np.where(
+                    total > 0, self.weighted[date] / total, mean
+                )
+        return agg
+
+    def pop(self, date):
+        """Takes the aggregated output of a complete date out of the aggregator.
+
+        Returns
+        -------
+        data : numpy.ndarray
+            Aggregated output, see aggregate.
+        sims : list of tuple
+            (task_id, params, wind_key) of the simulations of the date, by task.
+        computed : numpy.ndarray or None
+            Number of simulations that computed each point, for masked grids.
+        """
+        data = self.aggregate(date)
+        sims = sorted(self.sims.pop(date), key=lambda sim: sim[0])
+        computed = self.computed.pop(date, None)
+        del self.aggregates[date], self.weighted[date], self.counts[date]
+        return data, sims, computed
+
+
+class RunManifest:
+    """Append-only record of the progress of a run, in JSON lines format.
+
+    The first line identifies the multiphase configuration file by the SHA-256
+    hash of its contents. Each following line records either a simulation whose
+    output was saved, a simulation that failed, or a phase that was written to the
+    HDF file. The last record of a simulation is its status. Failed simulations
+    are run again when the run is resumed.
+
+    Parameters
+    ----------
+    filename : str
+        Manifest file.
+    config_hash : str
+        SHA-256 hash of the multiphase configuration file.
+    resume : bool, optional
+        If True and the manifest exists, the progress it records is read and new
+        records are appended. Otherwise, the manifest is started afresh.
+    """
+
+    def __init__(self, filename, config_hash, resume=False):
+        self.filename = filename
+        self.done = set()
+        # Last failure record of each simulation that has not completed since
+        self.failed = {}
+        self.exported = set()
+        if resume and os.path.exists(filename):
+            with open(filename, "r") as f:
+                records = []
+                for line in f:
+                    try:
+                        records += [json.loads(line)]
+                    except json.JSONDecodeError:
+                        # A record cut short by a crash.
+                        logging.warning(f"Ignoring incomplete record in {filename}")
+            if not records or records[0].get("multiphase_config") != config_hash:
+                raise ValueError(
+                    f"{filename} records a run of a different multiphase"
+                    " configuration file."
+                )
+            for record in records[1:]:
+                if "task" in record:
+                    if record["status"] == "done":
+                        self.done.add(record["task"])
+                        self.failed.pop(record["task"], None)
+                    else:
+                        self.done.discard(record["task"])
+                        self.failed[record["task"]] = record
+                elif "phase" in record:
+                    self.exported.add(record["phase"])
+            self.file = open(filename, "a")
+        else:
+            self.file = open(filename, "w")
+            self._write({"multiphase_config": config_hash})
+
+    def _write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def task_done(self, task_id, **info):
+        """Records that the output of simulation ``task_id`` was saved."""
+        self.done.add(task_id)
+        self.failed.pop(task_id, None)
+        self._write({"task": int(task_id), **info, "status": "done"})
+
+    def task_failed(self, task_id, **info):
+        """Records that simulation ``task_id`` failed."""
+        self.done.discard(task_id)
+        record = {"task": int(task_id), **info, "status": "failed"}
+        self.failed[task_id] = record
+        self._write(record)
+
+    def phase_exported(self, phase_key):
+        """Records that the phase ``phase_key`` was written to the HDF file."""
+        self.exported.add(phase_key)
+        self._write({"phase": phase_key, "status": "exported"})
+
+    def close(self):
+        self.file.close()
+
+
+def _append(dset, rows):
+    """Appends rows to a resizable dataset, and returns the index of the first."""
+    start = dset.shape[0]
+    dset.resize(start + len(rows), axis=0)
+    dset[start:] = rows
+    return start
+
+
+def _compact(dset, keep, block_size=2**22):
+    """Removes the rows of a resizable dataset where ``keep`` is False, in place.
+
+    Rows are moved forward in blocks of about ``block_size`` values, so that the
+    dataset is never read into memory as a whole.
+    """
+    dropped = np.flatnonzero(~keep)
+    if len(dropped) == 0:
+        return
+    n_rows = max(1, block_size // max(1, int(np.prod(dset.shape[1:]))))
+    end = dropped[0]
+    for start in range(dropped[0], len(keep), n_rows):
+        stop = min(start + n_rows, len(keep))
+        rows = dset[start:stop][keep[start:stop]]
+        if len(rows):
+            dset[end : end + len(rows)] = rows
+            end += len(rows)
+    dset.resize(end, axis=0)
+
+
+class CampaignWriter:
+    """Writes all phases of a run to a single HDF5 file as they complete.
+
+    The grid and the wind profiles are written once, when the file is created.
+    Each date of a phase appends its aggregated outputs to the (date, node, field)
+    array ``sims/data``, or for masked grids its computed points to the compressed
+    sparse rows of ``sims/sparse``, and its simulations to the ``configs`` table,
+    as soon as all of them are in. The phase is committed by a row of the
+    ``phases`` table once all its dates are written. All tables are chunked,
+    compressed and resizable.
+
+    Parameters
+    ----------
+    filename : str
+        HDF file.
+    grid_file : str
+        Grid file the simulations are run on.
+    wind_store : WindStore
+        Wind profiles of all time steps of the run.
+    param_names : list of str
+        Names of the Tephra2 parameters.
+    resume : bool, optional
+        If True and the file exists, phases are appended to it. The dates of
+        phases that were not committed, and phases with failed simulations, are
+        discarded.
+    """
+
+    def __init__(self, filename, grid_file, wind_store, param_names, resume=False):
+        self.filename = filename
+        self.param_names = list(param_names)
+        self.wind_keys = sorted(wind_store.digests)
+        self.wind_index = {key: i for i, key in enumerate(self.wind_keys)}
+        if resume and os.path.exists(filename):
+            self.f = h5py.File(filename, "a")
+            stored_keys = [key.decode() for key in self.f["wind/times"][()]]
+            if stored_keys != self.wind_keys:
+                raise ValueError(
+                    f"{filename} holds wind data for other time steps than this run."
                 )
+            self._truncate()
+        else:
+            self.f = h5py.File(filename, "w")
+            self._create(grid_file, wind_store)
+
+    def _create(self, grid_file, wind_store):
+        f = self.f
+        str_dtype = h5py.string_dtype()
+
+        # Just adding the grid file to root because we only use one.
+        logging.info("Exporting simulation grid coordinates")
+        grid_col_names = ["Northing", "Easting", "Elevation"]
+        grid_df = pd.read_csv(
+            grid_file,
+            sep=" ",
+            names=grid_col_names,
+            header=None,
+            comment="#",
+            dtype=np.float64,
+        )
+        f.create_dataset("grid", data=grid_df.to_records(index=False))
 
-                # aggregate mass in mass/area column
-                agg_df["Kg/m^2"] = agg_df["Kg/m^2"].add(output_df["Kg/m^2"])
-            os.remove(config_file)
+        # Wind time steps with identical profiles share one profile.
+        logging.info(f"Exporting wind data for {len(self.wind_keys)} time steps")
+        wind_group = f.create_group("wind")
+        digests = list(dict.fromkeys(wind_store.digests[k] for k in self.wind_keys))
+        digest_index = {digest: i for i, digest in enumerate(digests)}
+        profiles = np.stack([wind_store.profiles[digest] for digest in digests])
+        profile_dset = wind_group.create_dataset(
+            "profiles", data=profiles, compression="gzip", shuffle=True
+        )
+        profile_dset.attrs["fields"] = ["Elevation", "Speed", "Direction"]
+        wind_group.create_dataset("sha256", data=digests, dtype=str_dtype)
+        wind_group.create_dataset("times", data=self.wind_keys, dtype=str_dtype)
+        wind_group.create_dataset(
+            "profile",
+            data=[digest_index[wind_store.digests[k]] for k in self.wind_keys],
+            dtype="i4",
+        )
+
+        def table(name, dtype):
+            f.create_dataset(
+                name,
+                shape=(0,),
+                maxshape=(None,),
+                chunks=(1024,),
+                dtype=dtype,
+                compression="gzip",
+                shuffle=True,
+            )
+
+        table(
+            "phases",
+            [
+                ("realisation", "i4"),
+                ("phase", "i4"),
+                ("phase type", str_dtype),
+                ("phase start", str_dtype),
+                ("phase end", str_dtype),
+                ("sims", "i4"),
+                ("failed sims", "i4"),
+                ("dates end", "i8"),
+                ("configs end", "i8"),
+            ],
+        )
+        table(
+            "sims/index",
+            [
+                ("realisation", "i4"),
+                ("phase", "i4"),
+                ("phase type", str_dtype),
+                ("date", str_dtype),
+                ("sims", "i4"),
+                ("first config", "i8"),
+            ],
+        )
+        table(
+            "configs",
+            [
+                ("sim", "i8"),
+                ("task", "i8"),
+                ("realisation", "i4"),
+                ("phase", "i4"),
+                ("phase type", str_dtype),
+                ("date", str_dtype),
+                ("wind", "i4"),
+            ]
+            + [(name, "f8") for name in self.param_names],
+        )
+
+    def _truncate(self):
+        """Discards what was written of phases that were not committed.
+
+        The dates of a phase are written as they complete, between those of the
+        other phases running at the same time, and the phase is committed by its
+        row of the phases table once all of them are written. Rows left by an
+        interrupted write are cut off, and then the dates of phases that were not
+        committed, or that were committed with failed simulations, are removed.
+        Those phases are written again once their simulations are run again.
+        """
+        f = self.f
+        index = f["sims/index"][()]
+        n_dates = len(index)
+        # The row of a date in sims/index is written last, after its outputs and
+        # configs.
+        configs_end = int(np.max(index["first config"] + index["sims"], initial=0))
+        f["configs"].resize(configs_end, axis=0)
+        if "sims/data" in f:
+            f["sims/data"].resize(n_dates, axis=0)
+        if "sims/sparse" in f:
+            sparse = f["sims/sparse"]
+            sparse["indptr"].resize(n_dates + 1, axis=0)
+            n_values = int(sparse["indptr"][-1])
+            sparse["data"].resize(n_values, axis=0)
+            sparse["nodes"].resize(n_values, axis=0)
+
+        phases = f["phases"][()]
+        complete = phases["failed sims"] == 0
+        committed = set(
+            zip(phases["realisation"][complete], phases["phase"][complete])
+        )
+        keep = np.array(
+            [key in committed for key in zip(index["realisation"], index["phase"])],
+            dtype=bool,
+        )
+        if keep.all() and complete.all():
+            return
+        dropped = set(zip(index["realisation"][~keep], index["phase"][~keep]))
+        logging.info(
+            f"Discarding {np.count_nonzero(~keep)} dates of {len(dropped)} phases"
+            f" that were not committed or had failed simulations from {self.filename}"
+        )
+        # Number of rows kept before each row
+        keep_configs = np.repeat(keep, index["sims"])
+        kept_dates = np.concatenate([[0], np.cumsum(keep)])
+        kept_configs = np.concatenate([[0], np.cumsum(keep_configs)])
+
+        configs = f["configs"][()][keep_configs]
+        configs["sim"] = kept_dates[configs["sim"]]
+        index = index[keep]
+        index["first config"] = kept_configs[index["first config"]]
+        phases = phases[complete]
+        phases["dates end"] = kept_dates[phases["dates end"]]
+        phases["configs end"] = kept_configs[phases["configs end"]]
+        for name, rows in [
+            ("configs", configs),
+            ("sims/index", index),
+            ("phases", phases),
+        ]:
+            f[name].resize(len(rows), axis=0)
+            if len(rows):
+                f[name][:] = rows
+
+        if "sims/data" in f:
+            _compact(f["sims/data"], keep)
+        if "sims/sparse" in f:
+            lengths = np.diff(sparse["indptr"][()])
+            keep_values = np.repeat(keep, lengths)
+            _compact(sparse["data"], keep_values)
+            _compact(sparse["nodes"], keep_values)
+            indptr = np.concatenate([[0], np.cumsum(lengths[keep])])
+            sparse["indptr"].resize(len(indptr), axis=0)
+            sparse["indptr"][:] = indptr
+        f.flush()
+
+    @property
+    def exported(self):
+        """Keys of the phases committed without failed simulations, see phase_key."""
+        keys = set()
+        for row in self.f["phases"][()]:
+            if row["failed sims"] > 0:
+                continue
+            realisation = None if row["realisation"] < 0 else row["realisation"]
+            keys.add(phase_key(row["phase"], realisation))
+        return keys
+
+    def _sims_data(self, columns, n_points):
+        if "sims/sparse" in self.f:
+            raise ValueError(f"{self.filename} holds the outputs of a masked grid.")
+        if "sims/data" not in self.f:
+            self.f.create_dataset(
+                "sims/data",
+                shape=(0, n_points, len(columns)),
+                maxshape=(None, n_points, len(columns)),
+                chunks=(1, min(n_points, 8192), len(columns)),
+                dtype="f8",
+                compression="gzip",
+                shuffle=True,
+            ).attrs["fields"] = list(columns)
+        dset = self.f["sims/data"]
+        if list(dset.attrs["fields"]) != list(columns) or dset.shape[1] != n_points:
+            raise ValueError(
+                f"Tephra2 output of {columns} on {n_points} points does not match"
+                f" the outputs already in {self.filename}."
+            )
+        return dset
+
+    def _sims_sparse(self, columns):
+        if "sims/data" in self.f:
+            raise ValueError(f"{self.filename} holds the outputs of an unmasked grid.")
+        if "sims/sparse" not in self.f:
+            sparse = self.f.create_group("sims/sparse")
+            sparse.create_dataset(
+                "data",
+                shape=(0, len(columns)),
+                maxshape=(None, len(columns)),
+                chunks=(8192, len(columns)),
+                dtype="f8",
+                compression="gzip",
+                shuffle=True,
+            ).attrs["fields"] = list(columns)
+            sparse.create_dataset(
+                "nodes",
+                shape=(0,),
+                maxshape=(None,),
+                chunks=(8192,),
+                dtype="i4",
+                compression="gzip",
+                shuffle=True,
+            )
+            sparse.create_dataset(
+                "indptr", data=[0], maxshape=(None,), chunks=(1024,), dtype="i8"
+            )
+        sparse = self.f["sims/sparse"]
+        if list(sparse["data"].attrs["fields"]) != list(columns):
+            raise ValueError(
+                f"Tephra2 output of {columns} does not match the outputs already in"
+                f" {self.filename}."
+            )
+        return sparse
+
+    def write_date(self, aggregator, date):
+        """Appends the aggregated output of a complete date of a phase to the file.
+
+        The date is taken out of the aggregator, see PhaseAggregator.pop. The
+        phase is only committed by commit_phase, once all its dates are written.
+        """
+        phase, phase_type = aggregator.phases
+        realisation = -1 if aggregator.realisation is None else aggregator.realisation
+        columns = aggregator.header[0]
+        data, sims, computed = aggregator.pop(date)
 
-        agg_rec_arr = agg_df.to_records(index=False)
+        sim_index = self.f["sims/index"]
+        config_table = self.f["configs"]
+        row = sim_index.shape[0]
+        # Simulations are numbered by their order in the multiphase configuration
+        # file within a date, whatever the order they finished in.
+        configs = np.zeros(len(sims), dtype=config_table.dtype)
+        for i, (task_id, params, wind_key) in enumerate(sims):
+            configs[i] = (
+                row,
+                task_id,
+                realisation,
+                phase,
+                phase_type,
+                date,
+                self.wind_index[wind_key],
+                *params,
+            )
+
+        if computed is not None:
+            # Computed points of the date, as one compressed sparse row
+            sparse = self._sims_sparse(columns)
+            nodes = np.flatnonzero(computed)
+            _append(sparse["data"], data[nodes])
+            _append(sparse["nodes"], nodes)
+            _append(sparse["indptr"], [sparse["indptr"][-1] + len(nodes)])
+            logging.debug(
+                f"{aggregator.key}, {date}: {len(nodes)} of {aggregator.n_points}"
+                " grid points computed"
+            )
+        else:
+            _append(self._sims_data(columns, data.shape[0]), data[None])
+        first_config = _append(config_table, configs)
+        _append(
+            sim_index,
+            np.array(
+                [(realisation, phase, phase_type, date, len(sims), first_config)],
+                dtype=sim_index.dtype,
+            ),
+        )
+
+    def commit_phase(self, aggregator, timeline=None):
+        """Commits a phase, once all its dates were written by write_date.
+
+        Parameters
+        ----------
+        aggregator : PhaseAggregator
+            Aggregator of a complete phase.
+        timeline : common_utils.PhaseTimeline, optional
+            Timeline of the eruption. If given, the start and end dates of the
+            phase are stored in the phases table.
+        """
+        phase, phase_type = aggregator.phases
+        realisation = -1 if aggregator.realisation is None else aggregator.realisation
+        phase_start = phase_end = ""
+        if timeline is not None:
+            phase_start = str(timeline.phase_start(phase).date())
+            phase_end = str(timeline.phase_end(phase).date())
+        _append(
+            self.f["phases"],
+            np.array(
+                [
+                    (
+                        realisation,
+                        phase,
+                        phase_type,
+                        phase_start,
+                        phase_end,
+                        aggregator.n_sims,
+                        len(aggregator.failed),
+                        self.f["sims/index"].shape[0],
+                        self.f["configs"].shape[0],
+                    )
+                ],
+                dtype=self.f["phases"].dtype,
+            ),
+        )
+        self.f.flush()
+        logging.info(f"Committed {aggregator.key} to {self.filename}")
 
-        logging.debug(f"Writing aggregated output data for {date}")
-        sim_dset = sim_group.create_dataset(f"sim_{i}", data=agg_rec_arr)
-        sim_dset.attrs.create("phase", phases[0])
-        sim_dset.attrs.create("phase type", phases[1])
-        sim_dset.attrs["date"] = date
-        sim_dset.attrs["wind"] = wind_ref
-    f.close()
-    logging.info("Export success. Exiting.")
+    def close(self):
+        self.f.close()
 
 
 def extract_tephra2_wind(multiphase_config_file, netcdf_file):
@@ -198,6 +1092,42 @@ def extract_tephra2_wind(multiphase_config_file, netcdf_file):
     return wind_files
 
 
+def expected_cost(df):
+    """Returns the relative expected run time of each simulation in df.
+
+    Tephra2 integrates over COL_STEPS release heights up to the plume top, and
+    PART_STEPS grain size classes at each, so the run time grows with the
+    product of PLUME_HEIGHT, COL_STEPS and PART_STEPS. Missing parameters are
+    taken as 1.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Multiphase configuration, with one row per simulation.
+
+    Returns
+    -------
+    pandas.Series
+        Expected cost of each simulation, with the index of df.
+    """
+    cost = pd.Series(1.0, index=df.index)
+    for col in COST_COLUMNS:
+        if col in df.columns:
+            cost *= pd.to_numeric(df[col], errors="coerce").fillna(1.0)
+    return cost
+
+
+def default_scratch_dir():
+    """Returns /dev/shm if it is a writable directory, and None otherwise.
+
+    /dev/shm is a RAM-backed tmpfs on most Linux systems. With None, the scratch
+    directory is made in the system temporary directory, see tempfile.gettempdir.
+    """
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return None
+
+
 def create_tephra2_config_file(params, param_names, filename):
     with open(filename, "w") as f:
         for n, p in zip(param_names, params):
@@ -211,6 +1141,7 @@ def run_tephra2(
     wind_file_path,
     output_file_path,
     phase_tuple,
+    timeout=None,
 ):
     """
     Executes tephra2 with the given configuration, grid, and wind files, and saves the
@@ -223,9 +1154,14 @@ def run_tephra2(
     wind_file_path (str): The path to the wind file.
     output_file_path (str): The path to the file where the tephra2 output should be
     saved.
+    timeout (float): Time limit of the run in seconds. None for no limit.
 
     Returns:
     None
+
+    Raises:
+    subprocess.CalledProcessError: If tephra2 exits with a non-zero code.
+    subprocess.TimeoutExpired: If tephra2 runs for longer than timeout.
     """
     # Construct the command to execute tephra2
     command = [tephra2_path, config_file_path, grid_file_path, wind_file_path]
@@ -237,13 +1173,143 @@ def run_tephra2(
             f" \n{tephra2_path} {config_file_path} {grid_file_path} "
             f"{wind_file_path} > {output_file_path}"
         )
-        result = subprocess.run(command, capture_output=True, check=True)
+        result = subprocess.run(
+            command, capture_output=True, check=True, timeout=timeout
+        )
     except subprocess.CalledProcessError as e:
-        logging.critical(f'Tephra2 failed with error code {e.returncode}:"{e.output}"')
-        sys.exit(1)
+        logging.debug(
+            f'Tephra2 failed with error code {e.returncode}:"{e.stderr.decode()}"'
+        )
+        raise
     return result, phase_tuple
 
 
+def run_tephra2_task(task, param_names, retries=0, timeout=None):
+    """Runs one Tephra2 task, given as a (task_id, run_tephra2 arguments, parameter
+    values, number of grid points) tuple.
+
+    The Tephra2 configuration file is written, and the output parsed and saved to
+    the output file of the task if it has one, in the worker process. With a grid
+    mask, see init_worker, the task is run through GridMask.run. Failed runs,
+    that exit with an error, time out, write unreadable output, such as output
+    with fewer rows than grid points, or hit an OS error, such as a full disk or
+    an executable that cannot be started, are retried up to ``retries`` times.
+    Failures never stop the worker.
+
+    Returns
+    -------
+    tuple
+        The task id, so that results can be matched to their task when they are
+        consumed out of order, the parsed output, and None. If all attempts
+        failed, the output is None and the last element describes the error.
+    """
+    task_id, task_args, params, n_points = task
+    for attempt in range(1, retries + 2):
+        try:
+            create_tephra2_config_file(params, param_names, task_args[1])
+            if _grid_mask is None:
+                result, _ = run_tephra2(*task_args, timeout=timeout)
+                output = read_tephra2_output(result.stdout, n_points)
+            else:
+                output = _grid_mask.run(task_args, timeout=timeout)
+            if task_args[4] is not None:
+                save_tephra2_output(task_args[4], output)
+        except subprocess.CalledProcessError as e:
+            error = f"exit code {e.returncode}: {e.stderr.decode().strip()}"
+        except subprocess.TimeoutExpired:
+            error = f"timed out after {timeout} seconds"
+        except ValueError as e:
+            error = f"unreadable output: {e}"
+        except OSError as e:
+            error = f"OS error: {e}"
+        else:
+            return task_id, output, None
+        logging.warning(
+            f"Tephra2 task {task_id} failed on attempt {attempt} of {retries + 1}:"
+            f" {error}"
+        )
+    return task_id, None, error
+
+
+@lru_cache(maxsize=None)
+def parse_tephra2_header(header):
+    """Parses the header line of Tephra2 output.
+
+    All runs on the same grid share one header, so the result is cached.
+
+    Parameters
+    ----------
+    header : str
+        The header line, e.g. "#Easting Northing Elev. Kg/m^2 [-7->-6) ...".
+
+    Returns
+    -------
+    tuple
+        The column names, the indexes of the phi class columns, and the index of
+        the mass load column.
+    """
+    columns = tuple(header.lstrip("#").split())
+    intervals = np.flatnonzero([PHI_INTERVAL_REGEX.fullmatch(c) for c in columns])
+    intervals.flags.writeable = False
+    return columns, intervals, columns.index(LOAD_COLUMN)
+
+
+def read_tephra2_output(stdout, n_points=None):
+    """Reads the stdout of a Tephra2 run.
+
+    The numeric body is parsed straight into a float64 array.
+
+    Parameters
+    ----------
+    stdout : bytes
+        Output of Tephra2: a header line followed by one line per grid point.
+    n_points : int, optional
+        Number of points of the grid file of the run. If given, output with
+        another number of rows, such as truncated output, raises ValueError.
+
+    Returns
+    -------
+    tuple
+        The parsed header, see parse_tephra2_header, and an array of shape
+        (n_points, n_columns) holding the output values.
+    """
+    header_line, _, body = stdout.partition(b"\n")
+    header = parse_tephra2_header(header_line.decode())
+    data = np.fromstring(body, sep=" ")
+    n_columns = len(header[0])
+    if data.size % n_columns:
+        raise ValueError(
+            f"Tephra2 output has {data.size} values, which is not a multiple of its"
+            f" {n_columns} columns."
+        )
+    data = data.reshape(-1, n_columns)
+    if n_points is not None and len(data) != n_points:
+        raise ValueError(
+            f"Tephra2 output has {len(data)} rows for {n_points} grid points."
+        )
+    return header, data
+
+
+def save_tephra2_output(filename, output):
+    """Saves a parsed Tephra2 output to a .npz file.
+
+    Outputs of masked grids, see GridMask.run, also hold the indexes of their
+    points.
+    """
+    header, data = output[:2]
+    nodes = {"nodes": output[2]} if len(output) > 2 else {}
+    np.savez(filename, columns=np.array(header[0]), data=data, **nodes)
+
+
+def load_tephra2_output(filename):
+    """Loads a Tephra2 output saved by save_tephra2_output."""
+    with np.load(filename) as npz:
+        output = (parse_tephra2_header(" ".join(npz["columns"])), npz["data"])
+        if "nodes" in npz.files:
+            output += (npz["nodes"],)
+        return output
+
+
 def main():
     # Parse command line arguments
     parser = argparse.ArgumentParser(
@@ -273,6 +1339,154 @@ def main():
         ),
     )
 
+    parser.add_argument(
+        "-c",
+        "--wind-cache",
+        help=(
+            "Directory for the preprocessed wind cache. If set, the wind data of"
+            " the --wind-resolution is memory-mapped from the cache when the"
+            " NetCDF file has been processed before at that resolution, and"
+            " written to it otherwise."
+        ),
+    )
+    parser.add_argument(
+        "-r",
+        "--wind-resolution",
+        default="D",
+        help=(
+            "Time resolution of the wind used for each eruption: a pandas frequency"
+            ' string such as "D" (daily means), "6h" or "h", or "nearest" for the'
+            " time step of the NetCDF file closest to each eruption. Resolutions"
+            " must split a day evenly. Finer resolutions need DATE to hold full"
+            " timestamps, see the --event-times option of"
+            ' tephra2_multiphase_generator.py. Defaults to "D".'
+        ),
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help=(
+            "Number of Tephra2 processes to run at once. Defaults to the number of"
+            " CPUs."
+        ),
+    )
+    parser.add_argument(
+        "-t",
+        "--timeline",
+        help=(
+            "Phase timeline file written by tephra2_multiphase_generator.py. Defaults"
+            " to <multiphase_config_file>_timeline.csv if that file exists."
+        ),
+    )
+
+    parser.add_argument(
+        "--phase-window",
+        type=int,
+        default=4,
+        help=(
+            "Number of phases whose simulations are queued together. Within each"
+            " window of phases the longest simulations are started first, and"
+            " windows are queued in phase order, so that only the phases of about"
+            " two windows are held in memory at once. Defaults to 4."
+        ),
+    )
+    parser.add_argument(
+        "--grid-tiles",
+        type=int,
+        default=1,
+        help=(
+            "Number of spatial tiles the grid is split into. Each simulation is run"
+            " as one Tephra2 task per tile, and the outputs of the tiles are"
+            " stitched back together. Defaults to 1, no splitting."
+        ),
+    )
+    parser.add_argument(
+        "--mask-threshold",
+        type=float,
+        help=(
+            "Enables adaptive grid masking. Each simulation is first run on a"
+            " pilot grid of every --pilot-stride-th grid point, and the other"
+            " points are only computed near pilot points with a load above"
+            " MASK_THRESHOLD kg/m^2. Points that are not computed are stored as"
+            " zeros. Cannot be combined with --grid-tiles."
+        ),
+    )
+    parser.add_argument(
+        "--pilot-stride",
+        type=int,
+        default=4,
+        help=(
+            "Spacing of the pilot grid of --mask-threshold, in grid points along"
+            " each axis. Defaults to 4."
+        ),
+    )
+    parser.add_argument(
+        "--result-cache",
+        help=(
+            "Directory of the result cache. If set, simulations that only differ"
+            " in ERUPTION_MASS, with the same wind profile, are run once, and the"
+            " output is scaled to the mass of each. Outputs are kept in the cache"
+            " and reused by later runs. Cannot be combined with --mask-threshold."
+        ),
+    )
+    parser.add_argument(
+        "--result-cache-size",
+        type=float,
+        default=1024,
+        help=(
+            "Maximum size of the result cache in MB. The least recently used"
+            " outputs are removed beyond it. Defaults to 1024."
+        ),
+    )
+    parser.add_argument(
+        "--height-tolerance",
+        type=float,
+        help=(
+            "Enables binning of plume heights. Each PLUME_HEIGHT is rounded to the"
+            " nearest of a geometric sequence of heights spaced by this fraction,"
+            " e.g. 0.05 for 5%%. Simulations that share a binned height and"
+            " only differ in ERUPTION_MASS are run once, and the output is scaled"
+            " to the mass of each. Cannot be combined with --mask-threshold."
+        ),
+    )
+    parser.add_argument(
+        "--scratch-dir",
+        default=default_scratch_dir(),
+        help=(
+            "Directory for the configuration and wind files passed to Tephra2."
+            " Defaults to /dev/shm, a RAM-backed file system, when it is"
+            " available, and to the system temporary directory otherwise."
+        ),
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=2,
+        help=(
+            "Number of times a failed Tephra2 run is retried before it is reported"
+            " as failed. Defaults to 2."
+        ),
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help=(
+            "Time limit of a single Tephra2 run in seconds. Runs that take longer"
+            " are stopped and count as failed. No limit by default."
+        ),
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help=(
+            "Resume an interrupted run. Phases already written and simulations"
+            " already completed, as recorded in <out_file>_manifest.jsonl, are"
+            " skipped."
+        ),
+    )
+
     log_group = parser.add_mutually_exclusive_group()
     log_group.add_argument(
         "-q", "--quiet", action="store_true", help="Suppress all output"
@@ -303,139 +1517,450 @@ def main():
         args.grid_file,
         args.tephra2_path,
     )
+    if args.phase_window < 1:
+        parser.error("--phase-window must be at least 1.")
+    n_grid_points = len(read_grid_lines(args.grid_file)[1])
+    if not 1 <= args.grid_tiles <= n_grid_points:
+        parser.error(
+            f"--grid-tiles must be between 1 and the {n_grid_points} points of"
+            " the grid."
+        )
+    if args.wind_resolution != NATIVE:
+        bin_width(args.wind_resolution)
+    if args.mask_threshold is not None and args.grid_tiles > 1:
+        raise ValueError("--mask-threshold cannot be combined with --grid-tiles.")
+    if args.mask_threshold is not None and args.result_cache is not None:
+        raise ValueError("--mask-threshold cannot be combined with --result-cache.")
+    if args.mask_threshold is not None and args.height_tolerance is not None:
+        raise ValueError(
+            "--mask-threshold cannot be combined with --height-tolerance."
+        )
+    if args.height_tolerance is not None and args.height_tolerance <= 0:
+        raise ValueError("--height-tolerance must be positive.")
 
     total_start_time = time.time()
 
-    # Create NetCDFWindExtractor object
-    logging.info("Initialising wind extractor (This takes a while...)")
+    # Read in multiphase configuration file
+    df_multiphase = pd.read_csv(args.multiphase_config_file)
+
+    # Create NetCDFWindExtractor object, loading only the wind data for the dates
+    # in the multiphase configuration file. The window is padded by a day so the
+    # nearest time step of an eruption just before midnight is always loaded.
+    event_times = pd.to_datetime(df_multiphase["DATE"]).values
+    time_window = (
+        event_times.min() - np.timedelta64(1, "D"),
+        event_times.max() + np.timedelta64(1, "D"),
+    )
+    logging.info(
+        f"Initialising wind extractor for {time_window[0]} to {time_window[1]}"
+        f" at {args.wind_resolution} resolution"
+    )
     start_time = time.time()
-    wind_extractor = NetCDFWindExtractor(args.netcdf_file)
+    wind_extractor = NetCDFWindExtractor(
+        args.netcdf_file,
+        cache_dir=args.wind_cache,
+        time_window=time_window,
+        resolution=args.wind_resolution,
+    )
     elapsed_time = time.time() - start_time
     logging.info(f"Wind Extractor initialised in {elapsed_time:.2f} seconds")
 
-    # Read in multiphase configuration file
-    df_multiphase = pd.read_csv(args.multiphase_config_file)
-    param_names = df_multiphase.columns.values[3:]
+    # Match every eruption to a wind time step, and extract the wind profiles of
+    # all time steps at once.
+    logging.info("Extracting wind data")
+    start_time = time.time()
+    wind_cube = wind_extractor.cube
+    if np.any(np.diff(wind_cube.times) < np.timedelta64(1, "D")) and np.all(
+        event_times == event_times.astype("datetime64[D]")
+    ):
+        logging.warning(
+            "DATE holds no time of day, so every eruption is matched to the wind at"
+            f" midnight although the wind resolution is {args.wind_resolution}."
+            " Give DATE as e.g. 2023-03-27T14:00 to use sub-daily wind."
+        )
+    wind_times = wind_cube.times[wind_cube.time_index(event_times)]
+    key_unit = "D" if args.wind_resolution == "D" else "s"
+    wind_keys = pd.Series(
+        np.datetime_as_string(wind_times, unit=key_unit), index=df_multiphase.index
+    )
+    unique_keys, first_idx = np.unique(wind_keys.values, return_index=True)
+    wind_profiles = wind_extractor.extract_tephra2_wind_array(wind_times[first_idx])
+    elapsed_time = time.time() - start_time
+    logging.info(
+        f"Wind data for {len(unique_keys)} time steps extracted in"
+        f" {elapsed_time:.2f} seconds"
+    )
 
+    timeline_file = args.timeline
+    if timeline_file is None:
+        timeline_file = common_utils.timeline_filename(args.multiphase_config_file)
+    timeline = None
+    if os.path.exists(timeline_file):
+        logging.info(f"Reading phase timeline from {timeline_file}")
+        timeline = common_utils.PhaseTimeline.from_csv(timeline_file)
+        logging.info(f"Eruption runs from {timeline.start} to {timeline.end}")
+    elif args.timeline is not None:
+        raise ValueError(f"File {timeline_file} not found.")
+    param_names = [
+        col for col in df_multiphase.columns if col not in common_utils.META_COLUMNS
+    ]
+
+    # The manifest records the progress of the run, so that an interrupted run
+    # can be resumed with --resume. Saved simulation outputs are kept in the
+    # temporary directory until their phase is exported.
     temp_dir = ".temp"
-    try:
-        os.mkdir(temp_dir)
-    except FileExistsError:
-        shutil.rmtree(temp_dir)
-        os.mkdir(temp_dir)
-    phase_list = np.sort(list(set(df_multiphase["PHASE"])))
+    manifest = RunManifest(
+        f"{args.out_file}_manifest.jsonl",
+        file_hash(args.multiphase_config_file),
+        resume=args.resume,
+    )
+    if args.resume:
+        os.makedirs(temp_dir, exist_ok=True)
+        logging.info(
+            f"Resuming from {manifest.filename}: {len(manifest.exported)} phases"
+            f" exported, {len(manifest.done)} simulations completed"
+        )
+    else:
+        try:
+            os.mkdir(temp_dir)
+        except FileExistsError:
+            shutil.rmtree(temp_dir)
+            os.mkdir(temp_dir)
 
-    def process_tephra2_results(
-        results, grid_file=args.grid_file, out_file=args.out_file
-    ):
-        res_df_list = []
-        config_file_list = []
-        wind_file_list = []
-        for result in results:
-            res, phase_tuple = result
-            output = res.stdout.decode().splitlines()
-            output = [line.replace("#", "").split(" ") for line in output]
-            res_df = pd.DataFrame(
-                output[1:],
-                columns=output[0],
+    # Input files of Tephra2 only live as long as the run, so they are written to
+    # a scratch directory, RAM-backed by default. Outputs saved for --resume
+    # stay in the temporary directory.
+    scratch_dir = tempfile.mkdtemp(prefix="tephra2_", dir=args.scratch_dir)
+    # Removed even if the run fails, so that no files are left in RAM.
+    atexit.register(shutil.rmtree, scratch_dir, ignore_errors=True)
+    logging.info(f"Writing Tephra2 input files to {scratch_dir}")
+
+    # Write each distinct wind profile to a Tephra2 wind file once.
+    wind_store = WindStore(scratch_dir)
+    for wind_key, profile in zip(unique_keys, wind_profiles):
+        wind_store.add(wind_key, profile)
+    logging.info(
+        f"{len(wind_store)} distinct wind profiles for {len(unique_keys)} time steps"
+    )
+
+    # With --grid-tiles, every simulation is run as one Tephra2 task per tile.
+    grid_tiles = GridTiles(args.grid_file, args.grid_tiles, scratch_dir)
+    if len(grid_tiles) > 1:
+        logging.info(
+            f"Splitting the {grid_tiles.n_points} grid points into"
+            f" {len(grid_tiles)} tiles"
+        )
+
+    # With --mask-threshold, every simulation is run on a pilot grid first, and
+    # then only on the points near its deposit.
+    grid_mask = None
+    if args.mask_threshold is not None:
+        grid_mask = GridMask(
+            args.grid_file, args.pilot_stride, args.mask_threshold, scratch_dir
+        )
+        logging.info(
+            f"Masking the grid from a pilot grid of {len(grid_mask.pilot_nodes)}"
+            f" of its {grid_mask.n_points} points"
+        )
+
+    # With --result-cache or --height-tolerance, simulations that only differ in
+    # eruption mass are run once. The result cache reuses outputs across runs.
+    memoize = args.result_cache is not None or args.height_tolerance is not None
+    if memoize:
+        if MASS_COLUMN not in param_names:
+            raise ValueError(
+                f"--result-cache and --height-tolerance need the {MASS_COLUMN}"
+                f" column in {args.multiphase_config_file}."
             )
-            res_df.replace("", np.nan)
-            res_df_list += [res_df]
-            config_file_list += [res.args[1]]
-            wind_file_list += [res.args[3]]
-
-        export_to_hdf(
-            res_df_list,
-            config_file_list,
-            wind_file_list,
-            grid_file,
-            out_file,
-            phase_tuple,
-        )
-
-    with mp.Pool(processes=8) as pool:
-        # For each phase in the phase list
-        for phase in phase_list:
-            input_list = []
-            wind_file_list = []
-            config_file_list = []
-            dates_list = []
-
-            # For each paroxysm in the phase
-            for i, df_phase in df_multiphase[
-                df_multiphase["PHASE"] == phase
-            ].iterrows():
-                phase_name = df_phase["PHASE_TYPE"]
-                tephra2_params = df_phase[param_names].values
-                date = df_phase["DATE"]
-                dates_list += [date]
-
-                # Check if wind file already exists.
-                wind_filename = os.path.join(temp_dir, f"wind_{date}.dat")
-                if not os.path.exists(wind_filename):
-                    # Extract wind data
-                    logging.info(f"Extracting wind data for date {date}")
-                    start_time = time.time()
-                    wind_df = wind_extractor.extract_tephra2_wind(date)[0]
-                    elapsed_time = time.time() - start_time
-                    logging.debug(f"Wind data extracted in {elapsed_time:.2f} seconds")
-
-                    # Write wind data to wind file
-                    logging.debug(f"Writing wind data to file {wind_filename}")
-                    start_time = time.time()
-                    wind_df.to_csv(wind_filename, sep=" ", header=False, index=False)
-                    elapsed_time = time.time() - start_time
-                    logging.debug(
-                        f"Wind data written to file in {elapsed_time:.2f} seconds"
-                    )
-                wind_file_list += [wind_filename]
+        mass_index = param_names.index(MASS_COLUMN)
+        setup = hashlib.sha256(
+            f"{file_hash(args.grid_file)}:{file_hash(args.tephra2_path)}".encode()
+        ).hexdigest()
+    if args.height_tolerance is not None:
+        if "PLUME_HEIGHT" not in param_names:
+            raise ValueError(
+                "--height-tolerance needs the PLUME_HEIGHT column in"
+                f" {args.multiphase_config_file}."
+            )
+        height_index = param_names.index("PLUME_HEIGHT")
+    result_cache = None
+    if args.result_cache is not None:
+        result_cache = ResultCache(
+            args.result_cache, max_size=int(args.result_cache_size * 2**20)
+        )
+        logging.info(
+            f"Using the result cache {args.result_cache}, holding"
+            f" {len(result_cache)} outputs"
+        )
 
-                # Create Tephra2 configuration file
-                tephra2_filename = os.path.join(
-                    temp_dir, f"config_file{i:06d}_phase{int(phase):03d}_{date}.dat"
-                )
-                logging.debug(f"Creating Tephra2 configuration file {tephra2_filename}")
-                start_time = time.time()
-                create_tephra2_config_file(
-                    tephra2_params, param_names, tephra2_filename
-                )
-                elapsed_time = time.time() - start_time
-                logging.debug(
-                    "Tephra2 configuration written to file in"
-                    f" {elapsed_time:.2f} seconds"
+    # All phases, and all realisations, are written to <out_file>.h5.
+    writer = CampaignWriter(
+        f"{args.out_file}.h5",
+        args.grid_file,
+        wind_store,
+        param_names,
+        resume=args.resume,
+    )
+    exported = writer.exported
+
+    if "REALISATION" in df_multiphase.columns:
+        phase_groups = df_multiphase.groupby(["REALISATION", "PHASE"], sort=True)
+    else:
+        phase_groups = df_multiphase.groupby(["PHASE"], sort=True)
+
+    # Simulations are aggregated by the date of their event, whichever wind time
+    # step they were run with.
+    event_dates = pd.to_datetime(df_multiphase["DATE"]).dt.strftime("%Y-%m-%d")
+
+    # Results are consumed as they complete, and folded into the aggregator of
+    # their phase. A date is written as soon as all of its simulations are in, and
+    # a phase is committed once all of its dates are.
+    tasks = []
+    task_info = {}
+    task_records = {}
+    resumed = []
+    # Window of phases of each simulation, see --phase-window
+    task_window = {}
+    n_phases = 0
+    # Phases committed with failed simulations. Their saved outputs are kept for
+    # --resume, which discards them and runs their failed simulations again.
+    provisional = []
+    # Simulations of each result key, as (task_id, mass) tuples. Only the first is
+    # run, and the outputs of the others are scaled from its output.
+    duplicates = {}
+    task_keys = {}
+    cache_hits = 0
+
+    def collect_output(task_id, output):
+        aggregator, params, event_date, wind_key, _ = task_info.pop(task_id)
+        if output is None:
+            aggregator.fail(task_id, event_date)
+        else:
+            aggregator.add(task_id, output, params, event_date, wind_key)
+        # Dates are written, and freed, as soon as all their simulations are in
+        while aggregator.ready:
+            writer.write_date(aggregator, aggregator.ready.pop(0))
+        if not aggregator.done:
+            return
+        if not aggregator.n_sims:
+            logging.error(
+                f"All simulations of {aggregator.key} failed, it is not written"
+            )
+            return
+        writer.commit_phase(aggregator, timeline)
+        if aggregator.failed:
+            logging.warning(
+                f"Wrote {aggregator.key} without its {len(aggregator.failed)} failed"
+                " simulations. They are run again on --resume."
+            )
+            provisional.append(aggregator.key)
+            return
+        manifest.phase_exported(aggregator.key)
+        for temp_file in aggregator.temp_files:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+    def finish(task_id, output, error):
+        if error is None:
+            manifest.task_done(task_id, **task_records[task_id])
+        else:
+            manifest.task_failed(
+                task_id,
+                **task_records[task_id],
+                attempts=args.retries + 1,
+                error=error,
+            )
+        collect_output(task_id, output)
+
+    # For each phase in the phase list
+    for _, df_group in phase_groups:
+        phase = df_group["PHASE"].iloc[0]
+        record = {"phase": int(phase)}
+        realisation = None
+        if "REALISATION" in df_group.columns:
+            realisation = int(df_group["REALISATION"].iloc[0])
+            record["realisation"] = realisation
+        aggregator = PhaseAggregator(
+            (phase, df_group["PHASE_TYPE"].iloc[0]),
+            event_dates[df_group.index].tolist(),
+            realisation,
+            n_points=grid_tiles.n_points,
+        )
+        # The HDF file, not the manifest, tells which phases were committed.
+        if aggregator.key in exported:
+            logging.info(f"Skipping {aggregator.key}, already in {writer.filename}")
+            continue
+        window = n_phases // args.phase_window
+        n_phases += 1
+
+        # For each paroxysm in the phase
+        for i, df_phase in df_group.iterrows():
+            task_window[i] = window
+            phase_name = df_phase["PHASE_TYPE"]
+            tephra2_params = df_phase[param_names].to_numpy(dtype=np.float64)
+            date = df_phase["DATE"]
+            event_date = event_dates[i]
+
+            wind_key = wind_keys[i]
+            wind_filename = wind_store.filename(wind_key)
+
+            output_filename = os.path.join(
+                temp_dir, f"output{i:06d}_phase{int(phase):03d}_{date}.npz"
+            )
+            aggregator.temp_files += [output_filename]
+            task_info[i] = (
+                aggregator,
+                tephra2_params,
+                event_date,
+                wind_key,
+                output_filename,
+            )
+            task_records[i] = {"date": date, **record}
+            if i in manifest.done and os.path.exists(output_filename):
+                resumed += [(i, output_filename)]
+                continue
+
+            # With --height-tolerance, Tephra2 is run at the binned plume height.
+            # The parameters written to HDF are those of the configuration file.
+            run_params = tephra2_params
+            if args.height_tolerance is not None:
+                run_params = tephra2_params.copy()
+                run_params[height_index] = bin_height(
+                    run_params[height_index], args.height_tolerance
                 )
-                output_filename = os.path.join(
-                    temp_dir, f"output{i:06d}_phase{int(phase):03d}_{date}.dat"
+
+            mass = run_params[mass_index] if memoize else 0
+            if mass > 0:
+                key = result_key(
+                    run_params, param_names, wind_store.digests[wind_key], setup
                 )
+                cached = None
+                if result_cache is not None:
+                    cached = result_cache.get(key, mass)
+                if cached is not None:
+                    cache_hits += 1
+                    finish(i, cached, None)
+                    continue
+                if key in duplicates:
+                    duplicates[key] += [(i, mass)]
+                    continue
+                duplicates[key] = [(i, mass)]
+                task_keys[i] = key
 
-                config_file_list += [tephra2_filename]
+            grid_files = grid_tiles.files if grid_mask is None else [grid_mask.file]
+            for tile, tile_file in enumerate(grid_files):
+                # The Tephra2 configuration file is written by the worker that
+                # runs the task. The outputs of tiles are saved once stitched.
+                config_name = f"config_file{i:06d}_phase{int(phase):03d}_{date}"
+                tile_output_filename = output_filename
+                if len(grid_tiles) > 1:
+                    config_name += f"_tile{tile:03d}"
+                    tile_output_filename = None
+                tephra2_filename = os.path.join(scratch_dir, f"{config_name}.dat")
+                aggregator.temp_files += [tephra2_filename]
 
                 param_tuple = (
                     args.tephra2_path,
                     tephra2_filename,
-                    args.grid_file,
+                    tile_file,
                     wind_filename,
-                    output_filename,
+                    tile_output_filename,
                     (phase, phase_name),
                 )
-                input_list += [param_tuple]
+                tasks += [
+                    ((i, tile), param_tuple, run_params, len(grid_tiles.nodes[tile]))
+                ]
 
-                elapsed_time = time.time() - start_time
+    # All phases share one task queue. Within each window of phases the longest
+    # tasks are started first, so that no large Plinian run is left to finish
+    # alone at the end. Windows are queued in phase order, so phases complete,
+    # and are written and freed, as the run goes instead of all at its end.
+    cost = expected_cost(df_multiphase)
+    tile_size = [len(nodes) for nodes in grid_tiles.nodes]
+    tasks.sort(
+        key=lambda task: (
+            task_window[task[0][0]],
+            -cost[task[0][0]] * tile_size[task[0][1]],
+        )
+    )
+
+    if resumed:
+        logging.info(f"Reading {len(resumed)} completed simulations")
+    for task_id, output_filename in resumed:
+        collect_output(task_id, load_tephra2_output(output_filename))
 
-            def custom_callback(result):
-                return process_tephra2_results(result)
+    if memoize:
+        n_scaled = sum(len(sims) - 1 for sims in duplicates.values())
+        n_keyed = cache_hits + n_scaled + len(duplicates)
+        logging.info(
+            f"{cache_hits} simulations read from the result cache, and {n_scaled}"
+            f" to be scaled from the {len(duplicates)} that are run"
+        )
 
-            start_time = time.time()
-            _ = pool.starmap_async(run_tephra2, input_list, callback=custom_callback)
+    logging.info(f"Running {len(tasks)} Tephra2 simulations on {args.workers} workers")
+    run_task = partial(
+        run_tephra2_task,
+        param_names=param_names,
+        retries=args.retries,
+        timeout=args.timeout,
+    )
+    with mp.Pool(
+        processes=args.workers, initializer=init_worker, initargs=(grid_mask,)
+    ) as pool:
+        for (task_id, tile), output, error in pool.imap_unordered(run_task, tasks):
+            if len(grid_tiles) > 1:
+                stitched = grid_tiles.add(task_id, tile, output, error)
+                if stitched is None:
+                    continue
+                output, error = stitched
+                if error is None:
+                    save_tephra2_output(task_info[task_id][4], output)
+            if task_id in task_keys:
+                key = task_keys.pop(task_id)
+                (_, mass), *others = duplicates.pop(key)
+                if error is None and result_cache is not None:
+                    result_cache.put(key, output, mass)
+                for other, other_mass in others:
+                    other_output = None
+                    if error is None:
+                        other_output = scale_tephra2_output(output, other_mass / mass)
+                        save_tephra2_output(task_info[other][4], other_output)
+                    finish(other, other_output, error)
+            finish(task_id, output, error)
 
-            elapsed_time = time.time() - start_time
-        pool.close()
-        pool.join()
+    writer.close()
+    manifest.close()
+
+    if memoize and n_keyed:
+        logging.info(
+            f"Result hit rate {(cache_hits + n_scaled) / n_keyed:.1%}:"
+            f" {cache_hits} read from the cache and {n_scaled} scaled, of"
+            f" {n_keyed} simulations."
+        )
+    if result_cache is not None:
+        logging.info(
+            f"The result cache holds {len(result_cache)} outputs,"
+            f" {result_cache.size / 2**20:.1f} MB."
+        )
+
+    # The report lists the simulations whose last attempt failed, in this run or
+    # in the runs it resumes.
+    failed_file = f"{args.out_file}_failed_tasks.csv"
+    if manifest.failed:
+        failed = pd.DataFrame(list(manifest.failed.values())).drop(columns="status")
+        failed.sort_values("task").to_csv(failed_file, index=False)
+        logging.warning(
+            f"{len(failed)} of {len(df_multiphase)} Tephra2 simulations failed, see"
+            f" {failed_file}"
+        )
+    elif os.path.exists(failed_file):
+        os.remove(failed_file)
 
     total_elapsed_time = time.time() - total_start_time
     logging.info("DONE")
 
-    shutil.rmtree(temp_dir)
+    if not provisional:
+        shutil.rmtree(temp_dir)
 
 
 if __name__ == "__main__":
@@ -20,11 +20,19 @@ def main():
 
     parser.add_argument('runs', type=int, help='Number of runs to generate')
     parser.add_argument('output_file', type=str, help='Name of output file')
+    parser.add_argument(
+            '-s',
+            '--seed',
+            type=int,
+            help='Seed for the random number generator. Runs with the same' +
+            ' seed and input file generate identical output.'
+            )
     args = parser.parse_args()
 
-    config = common_utils.read_config_file(args.input_file)
+    config = common_utils.load_config_template(args.input_file)
 
-    run_df = common_utils.generate_runs(config, args.runs)
+    rng = common_utils.make_rng(args.seed)
+    run_df = common_utils.generate_runs(config, args.runs, rng=rng)
 
     with open(args.output_file, 'w') as f:
         run_df.to_csv(f, index_label="run")